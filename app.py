@@ -1,7 +1,13 @@
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, send_from_directory
-import os, json, hmac, hashlib, base64, time, threading, traceback, sys
+from flask import Flask, Response, request, jsonify, redirect, url_for, send_from_directory, make_response, stream_with_context, g
+from jinja2 import TemplateError
+import os, json, hmac, hashlib, base64, time, threading, traceback, sys, atexit, zipfile, zlib, queue
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 app = Flask(__name__)
 LOCK = threading.Lock()
@@ -11,44 +17,782 @@ TOKEN        = os.environ.get("API_TOKEN", "POKEMONVIETNAM")         # PC API to
 DATABASE_URL = os.environ.get("DATABASE_URL")                        # Neon
 UPLOAD_KEY   = (os.environ.get("UPLOAD_KEY") or "POKEMONVIETNAM")    # = SECRET trong game
 
+# Pool kết nối (mỗi gunicorn worker một pool, dùng chung giữa các thread)
+DB_POOL_MIN          = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX          = int(os.environ.get("DB_POOL_MAX", "8"))
+DB_POOL_TIMEOUT      = float(os.environ.get("DB_POOL_TIMEOUT", "10"))       # chờ lấy connection (giây)
+DB_POOL_MAX_IDLE     = float(os.environ.get("DB_POOL_MAX_IDLE", "240"))     # Neon suspend sau ~5 phút
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_RECONNECT    = float(os.environ.get("DB_POOL_RECONNECT", "60"))     # thử lại khi Neon đang thức dậy
+DB_POOL_CHECK_IDLE   = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))    # chỉ ping connection nằm yên lâu hơn (giây)
+
+# Cache BXH trong process: worker tự xoá khi ghi, worker khác hết hạn sau TTL
+BOARD_CACHE_TTL      = float(os.environ.get("BOARD_CACHE_TTL", "5"))
+BOARD_BUILD_WAIT     = float(os.environ.get("BOARD_BUILD_WAIT", "5"))   # chờ thread đang dựng /all tối đa (giây)
+
+# Phân trang BXH (/all chỉ render trang đầu, phần còn lại lấy qua /api/leaderboard)
+BOARD_PAGE           = int(os.environ.get("BOARD_PAGE", "100"))
+BOARD_PAGE_MAX       = int(os.environ.get("BOARD_PAGE_MAX", "500"))
+
+# Chỉ mục thứ hạng trong RAM: nạp lại nền sau RANK_TTL giây để thấy ghi từ worker khác
+RANK_TTL             = float(os.environ.get("RANK_TTL", "60"))
+
+# Số bản ghi tối đa mỗi lần gọi /api/report_batch
+BATCH_MAX            = int(os.environ.get("BATCH_MAX", "1000"))
+
+# Write-behind cho action=delta của /api/report: "sync" (mặc định) ghi ngay,
+# "buffered" gộp theo uid trong RAM rồi ghi một lệnh theo ngưỡng thời gian / số uid
+REPORT_MODE          = (os.environ.get("REPORT_MODE") or "sync").lower()
+DELTA_FLUSH_SEC      = float(os.environ.get("DELTA_FLUSH_SEC", "2"))
+DELTA_FLUSH_UIDS     = int(os.environ.get("DELTA_FLUSH_UIDS", "500"))
+DELTA_BUF_MAX        = int(os.environ.get("DELTA_BUF_MAX", "20000"))   # đầy -> ghi đồng bộ
+
+# LRU các (uid, ts, sig) Android vừa nhận: gửi lại y hệt bị chặn mà không cần hỏi DB
+ANDROID_SEEN_MAX     = int(os.environ.get("ANDROID_SEEN_MAX", "4096"))
+ANDROID_SEEN_TTL     = float(os.environ.get("ANDROID_SEEN_TTL", "600"))
+
+# Upload hàng loạt .bxh (nhiều file hoặc .zip)
+BULK_MAX_FILES       = int(os.environ.get("BULK_MAX_FILES", "500"))
+BULK_MAX_ENTRY       = int(os.environ.get("BULK_MAX_ENTRY", str(64 * 1024)))   # byte / file .bxh
+BULK_WORKERS         = int(os.environ.get("BULK_WORKERS", "4"))
+
+# Cập nhật BXH trực tiếp (SSE): gom thay đổi từ LISTEN/NOTIFY, đẩy tối đa 1 lô / LIVE_INTERVAL giây.
+# Mỗi kết nối SSE giữ một thread gthread -> LIVE_MAX_SUBS phải nhỏ hơn WEB_THREADS.
+LIVE_INTERVAL        = float(os.environ.get("LIVE_INTERVAL", "1"))
+LIVE_KEEPALIVE       = float(os.environ.get("LIVE_KEEPALIVE", "15"))
+LIVE_QUEUE           = int(os.environ.get("LIVE_QUEUE", "32"))
+LIVE_MAX_SUBS        = int(os.environ.get("LIVE_MAX_SUBS", "16"))
+LIVE_POLL            = int(os.environ.get("LIVE_POLL", "15"))   # quá LIVE_MAX_SUBS -> 204, trình duyệt tự hỏi lại mỗi LIVE_POLL giây
+
+# /metrics (Prometheus); đặt METRICS_TOKEN để bắt buộc ?token= hoặc Authorization: Bearer
+METRICS_TOKEN        = os.environ.get("METRICS_TOKEN") or ""
+
+# Lịch sử điểm: mỗi lần ghi -> 1 dòng score_events + cộng vào rollup giờ/ngày (trigger).
+# Dọn dữ liệu quá hạn chạy nền, tối đa 1 lần / HISTORY_PRUNE_SEC mỗi worker.
+HISTORY_EVENTS_DAYS  = int(os.environ.get("HISTORY_EVENTS_DAYS", "7"))
+HISTORY_HOURLY_DAYS  = int(os.environ.get("HISTORY_HOURLY_DAYS", "30"))
+HISTORY_DAILY_DAYS   = int(os.environ.get("HISTORY_DAILY_DAYS", "365"))
+HISTORY_PRUNE_SEC    = float(os.environ.get("HISTORY_PRUNE_SEC", "3600"))
+FORM_MIN_ROUNDS      = int(os.environ.get("FORM_MIN_ROUNDS", "3"))     # Form Top: bỏ qua người chơi quá ít trận
+
+# /api/export: mỗi lượt tải giữ một connection riêng (ngoài pool) suốt lúc client đọc chậm
+EXPORT_MAX           = int(os.environ.get("EXPORT_MAX", "2"))   # số lượt tải cùng lúc mỗi worker, quá -> 503
+
 def log(msg): print(msg); sys.stdout.flush()
 
+# ========= METRICS =========
+# Số liệu theo từng worker (mỗi process một bộ), render ở /metrics dạng text của Prometheus.
+_METRICS_LOCK = threading.Lock()
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS   = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+class Histogram:
+    """Histogram kiểu Prometheus: mỗi bộ nhãn giữ số đếm theo bucket + tổng + số lần."""
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with _METRICS_LOCK:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _METRICS_LOCK:
+            items = [(k, list(v)) for k, v in self.series.items()]
+        for labels, s in items:
+            base = _labels(self.labels, labels)
+            acc = 0
+            for le, c in zip(self.buckets + ("+Inf",), s):
+                acc += c
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (le,))} {acc}")
+            out.append(f"{self.name}_sum{base} {s[-1]:.6f}")
+            out.append(f"{self.name}_count{base} {acc}")
+        return out
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.series = {}
+
+    def inc(self, *labels, by=1):
+        with _METRICS_LOCK:
+            self.series[labels] = self.series.get(labels, 0) + by
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _METRICS_LOCK:
+            items = list(self.series.items())
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in items]
+        return out
+
+def _labels(names, values):
+    if not names:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in zip(names, values)) + "}"
+
+M_REQ_SECONDS  = Histogram("bxh_http_request_seconds", "Thời gian xử lý request theo route", ("route", "method"))
+M_REQ_TOTAL    = Counter("bxh_http_requests_total", "Số request theo route và mã trả về", ("route", "method", "status"))
+M_REQ_DB_SEC   = Histogram("bxh_request_db_seconds", "Tổng thời gian chạy lệnh DB trong một request", ("route",))
+M_REQ_DB_STMTS = Histogram("bxh_request_db_statements", "Số lệnh DB trong một request", ("route",), COUNT_BUCKETS)
+M_DB_SECONDS   = Counter("bxh_db_seconds_total", "Tổng thời gian chạy lệnh DB (cả thread nền)")
+M_DB_STMTS     = Counter("bxh_db_statements_total", "Tổng số lệnh DB (cả thread nền)")
+M_DB_ACQUIRE   = Histogram("bxh_db_acquire_seconds", "Thời gian chờ lấy connection từ pool")
+M_UPLOADS      = Counter("bxh_uploads_total", "Kết quả upload .bxh", ("path", "outcome"))
+METRICS = (M_REQ_SECONDS, M_REQ_TOTAL, M_REQ_DB_SEC, M_REQ_DB_STMTS, M_DB_SECONDS, M_DB_STMTS, M_DB_ACQUIRE, M_UPLOADS)
+
+_REQ_DB = threading.local()     # thời gian / số lệnh DB của request đang chạy trên thread này
+
+def _db_observe(dt):
+    M_DB_SECONDS.inc(by=dt)
+    M_DB_STMTS.inc()
+    if getattr(_REQ_DB, "active", False):
+        _REQ_DB.seconds += dt
+        _REQ_DB.stmts += 1
+
+class _TimedCursorMixin:
+    def execute(self, query, params=None, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            _db_observe(time.perf_counter() - t0)
+
+class TimedCursor(_TimedCursorMixin, psycopg.Cursor): pass
+class TimedServerCursor(_TimedCursorMixin, psycopg.ServerCursor): pass
+
+@app.before_request
+def _metrics_start():
+    g.t0 = time.perf_counter()
+    _REQ_DB.active, _REQ_DB.seconds, _REQ_DB.stmts = True, 0.0, 0
+
+@app.after_request
+def _metrics_end(resp):
+    # ghi số liệu khi server đóng response -> tính cả phần body stream (/all khi cache nguội)
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method, status, t0 = request.method, resp.status_code, g.t0
+    def done():
+        M_REQ_SECONDS.observe(time.perf_counter() - t0, route, method)
+        M_REQ_TOTAL.inc(route, method, status)
+        M_REQ_DB_SEC.observe(_REQ_DB.seconds, route)
+        M_REQ_DB_STMTS.observe(_REQ_DB.stmts, route)
+        _REQ_DB.active = False
+    resp.call_on_close(done)
+    return resp
+
 # ========= DB =========
+_POOL = None
+
+def db_pool():
+    """Pool mở lười (lần gọi đầu tiên trong worker) để không mang connection qua fork."""
+    global _POOL
+    if _POOL is None:
+        with LOCK:
+            if _POOL is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("Missing DATABASE_URL")
+                _POOL = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN,
+                    max_size=max(DB_POOL_MIN, DB_POOL_MAX),
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    reconnect_timeout=DB_POOL_RECONNECT,
+                    check=_db_check,
+                    kwargs={"autocommit": True},
+                    configure=_db_configure,
+                    reset=_db_reset,
+                    name="bxh",
+                    open=False,
+                )
+                _POOL.open()
+    return _POOL
+
+def db_close():
+    """Đóng pool của tiến trình này (lần dùng sau sẽ mở lại)."""
+    global _POOL
+    with LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
+
+def _db_configure(con):
+    # cursor đo thời gian từng lệnh cho /metrics
+    con.cursor_factory = TimedCursor
+    con.server_cursor_factory = TimedServerCursor
+    con.bxh_idle_since = time.monotonic()
+
+def _db_reset(con):
+    con.bxh_idle_since = time.monotonic()   # lúc trả về pool
+
+def _db_check(con):
+    # pool gọi check ở mọi lần getconn: chỉ tốn một round-trip ping khi connection đã nằm yên lâu
+    # (Neon có thể đã suspend / cắt kết nối), connection vừa dùng xong thì đưa ra luôn
+    if time.monotonic() - getattr(con, "bxh_idle_since", 0.0) > DB_POOL_CHECK_IDLE:
+        ConnectionPool.check_connection(con)
+
+@contextmanager
 def db_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("Missing DATABASE_URL")
-    return psycopg.connect(DATABASE_URL, autocommit=True)
+    # Dùng như cũ: `with db_conn() as con` -> mượn connection, trả lại pool khi thoát
+    t0 = time.perf_counter()
+    with db_pool().connection() as con:
+        M_DB_ACQUIRE.observe(time.perf_counter() - t0)
+        yield con
 
-def init_db():
-    with db_conn() as con, con.cursor() as cur:
-        # PC
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS scores (
-          uid        TEXT PRIMARY KEY,
-          name       TEXT NOT NULL,
-          rounds     INTEGER NOT NULL DEFAULT 0,
-          kos        INTEGER NOT NULL DEFAULT 0,
-          trainers   INTEGER NOT NULL DEFAULT 0,
-          extra      INTEGER NOT NULL DEFAULT 0,
-          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
-        )""")
+# Các kiểu sắp xếp (giống dropdown sortBy); hoà thì theo tên A-Z
+BOARD_SORTS = {
+    "default": ("trainers", "kos", "rounds", "extra"),
+    "kos":     ("kos", "trainers", "rounds", "extra"),
+    "rounds":  ("rounds", "trainers", "kos", "extra"),
+    "extra":   ("extra", "trainers", "kos", "rounds"),
+}
+
+# BXH gộp theo tên: trigger trên scores/android_scores cộng/trừ phần đóng góp của từng dòng
+# trong cùng transaction với lệnh ghi. n = số dòng đang góp vào tên đó (0 -> xoá dòng).
+# Mỗi tên bị đổi được NOTIFY trên kênh bxh_board ('*' = dựng lại toàn bộ), gửi đi khi commit.
+SQL_BOARD_FUNCS = """
+CREATE OR REPLACE FUNCTION board_sync() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' AND NEW.name = OLD.name THEN
+    IF (NEW.rounds, NEW.kos, NEW.trainers, NEW.extra) IS DISTINCT FROM
+       (OLD.rounds, OLD.kos, OLD.trainers, OLD.extra) THEN
+      UPDATE board SET rounds   = rounds   + NEW.rounds   - OLD.rounds,
+                       kos      = kos      + NEW.kos      - OLD.kos,
+                       trainers = trainers + NEW.trainers - OLD.trainers,
+                       extra    = extra    + NEW.extra    - OLD.extra
+       WHERE name = NEW.name;
+      PERFORM pg_notify('bxh_board', NEW.name);
+    END IF;
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    UPDATE board SET rounds   = rounds   - OLD.rounds,
+                     kos      = kos      - OLD.kos,
+                     trainers = trainers - OLD.trainers,
+                     extra    = extra    - OLD.extra,
+                     n        = n - 1
+     WHERE name = OLD.name;
+    DELETE FROM board WHERE name = OLD.name AND n <= 0;
+    PERFORM pg_notify('bxh_board', OLD.name);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO board(name, rounds, kos, trainers, extra, n)
+    VALUES (NEW.name, NEW.rounds, NEW.kos, NEW.trainers, NEW.extra, 1)
+    ON CONFLICT (name) DO UPDATE
+      SET rounds   = board.rounds   + EXCLUDED.rounds,
+          kos      = board.kos      + EXCLUDED.kos,
+          trainers = board.trainers + EXCLUDED.trainers,
+          extra    = board.extra    + EXCLUDED.extra,
+          n        = board.n + 1;
+    PERFORM pg_notify('bxh_board', NEW.name);
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION board_rebuild() RETURNS void AS $$
+BEGIN
+  DELETE FROM board;
+  INSERT INTO board(name, rounds, kos, trainers, extra, n)
+  SELECT name, SUM(rounds), SUM(kos), SUM(trainers), SUM(extra), COUNT(*)
+    FROM (SELECT name, rounds, kos, trainers, extra FROM scores
+          UNION ALL
+          SELECT name, rounds, kos, trainers, extra FROM android_scores) u
+   GROUP BY name;
+  PERFORM pg_notify('bxh_board', '*');
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION board_truncate() RETURNS trigger AS $$
+BEGIN
+  PERFORM board_rebuild();
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+"""
+
+# Lịch sử: trigger ghi phần chênh NEW - OLD (bỏ qua nếu không đổi) thành 1 event
+# và cộng dồn vào rollup theo giờ ('h') + ngày ('d'); src 'p' = PC, 'a' = Android.
+SQL_HISTORY_FUNCS = """
+CREATE OR REPLACE FUNCTION score_history() RETURNS trigger AS $$
+DECLARE
+  v_src "char" := CASE TG_TABLE_NAME WHEN 'scores' THEN 'p' ELSE 'a' END;
+  dr INTEGER := NEW.rounds;
+  dk INTEGER := NEW.kos;
+  dt INTEGER := NEW.trainers;
+  dx INTEGER := NEW.extra;
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    dr := dr - OLD.rounds; dk := dk - OLD.kos; dt := dt - OLD.trainers; dx := dx - OLD.extra;
+  END IF;
+  IF dr = 0 AND dk = 0 AND dt = 0 AND dx = 0 THEN
+    RETURN NULL;
+  END IF;
+  INSERT INTO score_events(src, uid, name, rounds, kos, trainers, extra)
+  VALUES (v_src, NEW.uid, NEW.name, dr, dk, dt, dx);
+  INSERT INTO score_rollup(grain, bucket, src, uid, name, rounds, kos, trainers, extra, n)
+  VALUES ('h', date_trunc('hour', now()), v_src, NEW.uid, NEW.name, dr, dk, dt, dx, 1),
+         ('d', date_trunc('day',  now()), v_src, NEW.uid, NEW.name, dr, dk, dt, dx, 1)
+  ON CONFLICT (grain, bucket, src, uid) DO UPDATE
+    SET name     = EXCLUDED.name,
+        rounds   = score_rollup.rounds   + EXCLUDED.rounds,
+        kos      = score_rollup.kos      + EXCLUDED.kos,
+        trainers = score_rollup.trainers + EXCLUDED.trainers,
+        extra    = score_rollup.extra    + EXCLUDED.extra,
+        n        = score_rollup.n + 1;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+"""
+
+# ========= MIGRATIONS =========
+# Schema theo version, chạy một lần mỗi lần deploy (Procfile release: flask --app app migrate).
+# DDL giữ IF NOT EXISTS để DB cũ (tạo bởi init_db() lúc import trước đây) nhận version mà không lỗi.
+def _m1_scores(con, cur):
+    # PC
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS scores (
+      uid        TEXT PRIMARY KEY,
+      name       TEXT NOT NULL,
+      rounds     INTEGER NOT NULL DEFAULT 0,
+      kos        INTEGER NOT NULL DEFAULT 0,
+      trainers   INTEGER NOT NULL DEFAULT 0,
+      extra      INTEGER NOT NULL DEFAULT 0,
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""")
+
+    # Android (có cả last_ts + last_sig để chống replay/duplicate)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS android_scores (
+      uid        TEXT PRIMARY KEY,
+      name       TEXT NOT NULL,
+      rounds     INTEGER NOT NULL DEFAULT 0,
+      kos        INTEGER NOT NULL DEFAULT 0,
+      trainers   INTEGER NOT NULL DEFAULT 0,
+      extra      INTEGER NOT NULL DEFAULT 0,
+      last_ts    BIGINT NOT NULL DEFAULT 0,
+      last_sig   TEXT   NOT NULL DEFAULT '',
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""")
+
+def _m2_board(con, cur):
+    # BXH gộp (PC + Android) theo tên, index theo thứ tự xếp hạng
+    cur.execute("SELECT to_regclass('board') IS NULL")
+    backfill = cur.fetchone()[0]
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS board (
+      name       TEXT PRIMARY KEY,
+      rounds     BIGINT  NOT NULL DEFAULT 0,
+      kos        BIGINT  NOT NULL DEFAULT 0,
+      trainers   BIGINT  NOT NULL DEFAULT 0,
+      extra      BIGINT  NOT NULL DEFAULT 0,
+      n          INTEGER NOT NULL DEFAULT 0
+    )""")
+    for sort, keys in BOARD_SORTS.items():
+        cols = ", ".join(k + " DESC" for k in keys)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS board_{sort}_idx ON board ({cols}, name)")
+    # tìm tên: prefix dùng btree, substring dùng trigram (nếu server có pg_trgm)
+    cur.execute("CREATE INDEX IF NOT EXISTS board_lname_idx ON board (lower(name) text_pattern_ops)")
+    try:
+        with con.transaction():
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute("CREATE INDEX IF NOT EXISTS board_lname_trgm ON board USING gin (lower(name) gin_trgm_ops)")
+    except psycopg.Error as e:
+        log(f"[DB] pg_trgm unavailable, substring search unindexed: {e}")
+    cur.execute(SQL_BOARD_FUNCS)
+    for t in ("scores", "android_scores"):
+        cur.execute(f"""
+        CREATE OR REPLACE TRIGGER {t}_board AFTER INSERT OR UPDATE OR DELETE ON {t}
+          FOR EACH ROW EXECUTE FUNCTION board_sync()""")
+        cur.execute(f"""
+        CREATE OR REPLACE TRIGGER {t}_board_truncate AFTER TRUNCATE ON {t}
+          FOR EACH STATEMENT EXECUTE FUNCTION board_truncate()""")
+    if backfill:
+        cur.execute("SELECT board_rebuild()")
+
+def _m3_seasons(con, cur):
+    # Mùa giải đã lưu: ảnh chụp bảng board lúc archive, index giống board nhưng đứng sau season_id
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS seasons (
+      id          SERIAL PRIMARY KEY,
+      label       TEXT        NOT NULL,
+      players     INTEGER     NOT NULL DEFAULT 0,
+      archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS season_board (
+      season_id  INTEGER NOT NULL REFERENCES seasons(id) ON DELETE CASCADE,
+      name       TEXT    NOT NULL,
+      rounds     BIGINT  NOT NULL DEFAULT 0,
+      kos        BIGINT  NOT NULL DEFAULT 0,
+      trainers   BIGINT  NOT NULL DEFAULT 0,
+      extra      BIGINT  NOT NULL DEFAULT 0,
+      PRIMARY KEY (season_id, name)
+    )""")
+    for sort, keys in BOARD_SORTS.items():
+        cols = ", ".join(k + " DESC" for k in keys)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS season_board_{sort}_idx ON season_board (season_id, {cols}, name)")
+    cur.execute("CREATE INDEX IF NOT EXISTS season_board_lname_idx ON season_board (season_id, lower(name) text_pattern_ops)")
+
+def _m4_history(con, cur):
+    # Lịch sử điểm: event thô chỉ thêm vào cuối (BRIN theo thời gian), truy vấn đọc từ rollup
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS score_events (
+      at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+      src      "char"      NOT NULL,
+      uid      TEXT        NOT NULL,
+      name     TEXT        NOT NULL,
+      rounds   INTEGER     NOT NULL,
+      kos      INTEGER     NOT NULL,
+      trainers INTEGER     NOT NULL,
+      extra    INTEGER     NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS score_events_at_brin ON score_events USING brin (at)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS score_rollup (
+      grain    "char"      NOT NULL,
+      bucket   TIMESTAMPTZ NOT NULL,
+      src      "char"      NOT NULL,
+      uid      TEXT        NOT NULL,
+      name     TEXT        NOT NULL,
+      rounds   BIGINT      NOT NULL DEFAULT 0,
+      kos      BIGINT      NOT NULL DEFAULT 0,
+      trainers BIGINT      NOT NULL DEFAULT 0,
+      extra    BIGINT      NOT NULL DEFAULT 0,
+      n        INTEGER     NOT NULL DEFAULT 0,
+      PRIMARY KEY (grain, bucket, src, uid)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS score_rollup_uid_idx ON score_rollup (uid, grain, bucket)")
+    cur.execute(SQL_HISTORY_FUNCS)
+    for t in ("scores", "android_scores"):
+        cur.execute(f"""
+        CREATE OR REPLACE TRIGGER {t}_history AFTER INSERT OR UPDATE ON {t}
+          FOR EACH ROW EXECUTE FUNCTION score_history()""")
 
-        # Android (có cả last_ts + last_sig để chống replay/duplicate)
+MIGRATIONS = [
+    (1, "scores + android_scores", _m1_scores),
+    (2, "board + triggers + search indexes", _m2_board),
+    (3, "season archive", _m3_seasons),
+    (4, "score history + rollups", _m4_history),
+]
+
+def migrate():
+    """Chạy các bước MIGRATIONS chưa có trong schema_version (một transaction); trả về version vừa chạy."""
+    with db_conn() as con, con.cursor() as cur, con.transaction():
+        # nhiều tiến trình migrate cùng lúc -> chạy lần lượt
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('bxh.migrate'))")
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS android_scores (
-          uid        TEXT PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version    INTEGER PRIMARY KEY,
           name       TEXT NOT NULL,
-          rounds     INTEGER NOT NULL DEFAULT 0,
-          kos        INTEGER NOT NULL DEFAULT 0,
-          trainers   INTEGER NOT NULL DEFAULT 0,
-          extra      INTEGER NOT NULL DEFAULT 0,
-          last_ts    BIGINT NOT NULL DEFAULT 0,
-          last_sig   TEXT   NOT NULL DEFAULT '',
-          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+          applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
         )""")
-init_db()
+        cur.execute("SELECT version FROM schema_version")
+        done = {r[0] for r in cur.fetchall()}
+        applied = []
+        for version, name, step in MIGRATIONS:
+            if version in done:
+                continue
+            step(con, cur)
+            cur.execute("INSERT INTO schema_version(version, name) VALUES (%s, %s)", (version, name))
+            log(f"[DB] migration {version}: {name}")
+            applied.append(version)
+    return applied
+
+@app.cli.command("migrate")
+def migrate_cmd():
+    """Tạo/cập nhật schema (flask --app app migrate); worker không chạy DDL lúc khởi động."""
+    applied = migrate()
+    log(f"[DB] schema version {MIGRATIONS[-1][0]} ({len(applied)} migration(s) applied)")
+
+@app.cli.command("rebuild-board")
+def rebuild_board_cmd():
+    """Dựng lại bảng board từ scores + android_scores (flask --app app rebuild-board)."""
+    with db_conn() as con, con.cursor() as cur, con.transaction():
+        # chặn ghi trong lúc dựng lại để không lệch số
+        cur.execute("LOCK TABLE scores, android_scores IN SHARE MODE")
+        cur.execute("SELECT board_rebuild()")
+        cur.execute("SELECT count(*) FROM board")
+        log(f"[BOARD] rebuilt {cur.fetchone()[0]} rows")
+
+# ========= RANK (order-statistics trong RAM) =========
+class RankIndex:
+    """Danh sách khoá (-trainers, -kos, -rounds, -extra, name) đã sắp xếp, chia bucket
+    như sortedcontainers: thêm/xoá O(log n + LOAD), tra thứ hạng O(n/LOAD + log n)."""
+    LOAD = 512
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.buckets, self.maxes = [], []
+        self.keys = {}        # name -> khoá hiện tại
+        self.uids = {}        # uid  -> name
+        self.loaded_at = 0.0
+        self.reloading = False
+
+    @staticmethod
+    def key(r):
+        return (-int(r["trainers"]), -int(r["kos"]), -int(r["rounds"]), -int(r["extra"]), r["name"])
+
+    @staticmethod
+    def row(key):
+        t, k, r, e, name = key
+        return {"name": name, "rounds": -r, "kos": -k, "trainers": -t, "extra": -e}
+
+    def _insert(self, key):
+        if not self.buckets:
+            self.buckets, self.maxes = [[key]], [key]
+            return
+        i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+        b = self.buckets[i]
+        insort(b, key)
+        self.maxes[i] = b[-1]
+        if len(b) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [b[:self.LOAD], b[self.LOAD:]]
+            self.maxes[i:i + 1] = [b[self.LOAD - 1], b[-1]]
+
+    def _remove(self, key):
+        i = bisect_left(self.maxes, key)
+        b = self.buckets[i]
+        del b[bisect_left(b, key)]
+        if b:
+            self.maxes[i] = b[-1]
+        else:
+            del self.buckets[i], self.maxes[i]
+
+    def _pos(self, key):
+        i = bisect_left(self.maxes, key)
+        return sum(len(b) for b in self.buckets[:i]) + bisect_left(self.buckets[i], key)
+
+    def _slice(self, start, stop):
+        out, base = [], 0
+        for b in self.buckets:
+            if base + len(b) > start:
+                out += b[max(0, start - base):stop - base]
+            base += len(b)
+            if base >= stop:
+                break
+        return out
+
+    def load(self, rows, uids):
+        keys = sorted(self.key(r) for r in rows)
+        buckets = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        with self.lock:
+            self.buckets, self.maxes = buckets, [b[-1] for b in buckets]
+            self.keys = {k[-1]: k for k in keys}
+            self.uids = dict(uids)
+            self.loaded_at = time.monotonic()
+
+    def apply(self, pairs, names, rows):
+        """Cập nhật các tên trong `names` theo `rows` (dòng board mới; thiếu = đã bị xoá),
+        ghi nhận uid -> name theo `pairs`."""
+        fresh = {r["name"]: self.key(r) for r in rows}
+        with self.lock:
+            if not self.loaded_at:
+                return
+            for n in names:
+                old = self.keys.pop(n, None)
+                if old is not None:
+                    self._remove(old)
+                if n in fresh:
+                    self.keys[n] = fresh[n]
+                    self._insert(fresh[n])
+            self.uids.update(pairs)
+
+    def rank_of(self, name):
+        with self.lock:
+            key = self.keys.get(name)
+            return None if key is None else self._pos(key) + 1
+
+    def lookup(self, uid, n):
+        with self.lock:
+            key = self.keys.get(self.uids.get(uid))
+            if key is None:
+                return None
+            pos = self._pos(key)
+            around = self._slice(max(0, pos - n), pos + n + 1)
+        first = max(0, pos - n) + 1
+        ranked = [dict(self.row(k), rank=first + i) for i, k in enumerate(around)]
+        me = pos + 1 - first
+        return {"rank": pos + 1, "total": len(self.keys), "row": ranked[me],
+                "above": ranked[:me], "below": ranked[me + 1:]}
+
+RANK = RankIndex()
+
+def rank_reload():
+    with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT name, rounds, kos, trainers, extra FROM board")
+        rows = cur.fetchall()
+        cur.execute("SELECT uid, name FROM scores UNION ALL SELECT uid, name FROM android_scores")
+        uids = [(r["uid"], r["name"]) for r in cur.fetchall()]
+    RANK.load(rows, uids)
+
+def _rank_reload_bg():
+    try:
+        rank_reload()
+    except Exception as e:
+        log(f"[RANK][ERROR] {e}\n{traceback.format_exc()}")
+    finally:
+        RANK.reloading = False
+
+def rank_ensure_fresh():
+    """Chưa nạp -> nạp ngay; quá RANK_TTL -> nạp lại ở thread nền, vẫn trả bản hiện có."""
+    if not RANK.loaded_at:
+        rank_reload()
+    elif time.monotonic() - RANK.loaded_at > RANK_TTL and not RANK.reloading:
+        RANK.reloading = True
+        threading.Thread(target=_rank_reload_bg, daemon=True).start()
+
+SQL_RANK_ROWS = "SELECT name, rounds, kos, trainers, extra FROM board WHERE name = ANY(%s)"
+
+def _rank_names(pairs):
+    """Tên cần đọc lại sau khi ghi các (uid, name): tên mới + tên cũ nếu uid đổi tên."""
+    names = {name for _, name in pairs}
+    names.update(RANK.uids[uid] for uid, _ in pairs if uid in RANK.uids)
+    return list(names)
+
+def _rank_touch_many(cur, pairs):
+    """Sau khi ghi: đọc lại dòng board của các tên bị ảnh hưởng trong một lệnh."""
+    if not RANK.loaded_at or not pairs:
+        return
+    names = _rank_names(pairs)
+    cur.execute(SQL_RANK_ROWS, (names,))
+    RANK.apply(pairs, names, cur.fetchall())
+
+def _rank_touch(cur, uid, name):
+    _rank_touch_many(cur, [(uid, name)])
 
 # ========= PC API =========
+def _parse_pc(data):
+    """Trường của một bản ghi PC -> (uid, name, action, rounds, kos, trainers, extra)."""
+    action   = (data.get("action") or "set").lower()
+    name     = (data.get("name")   or "Unknown").strip()[:40]
+    uid      = (data.get("uid")    or ("__name__:"+name))
+    rounds   = int(str(data.get("rounds") or 0))
+    kos      = int(str(data.get("kos") or 0))
+    trainers = int(str(data.get("trainers") or 0))
+    extra    = int(str(data.get("extra") or 0))
+    return uid, name, action, rounds, kos, trainers, extra
+
+_STAT_COLS = ("rounds", "kos", "trainers", "extra")
+INT4_MIN, INT4_MAX = -2**31, 2**31 - 1    # cột INTEGER của scores / android_scores
+
+def _in_int4(vals):
+    return all(INT4_MIN <= v <= INT4_MAX for v in vals)
+
+def _parse_pc_item(item):
+    """_parse_pc cho một phần tử batch, kiểm chặt hơn để lỗi của một phần tử không làm hỏng cả lệnh."""
+    if not isinstance(item, dict): raise ValueError("item is not an object")
+    if item.get("uid") is not None and not isinstance(item["uid"], str): raise ValueError("uid must be a string")
+    rec = _parse_pc(item)
+    if not _in_int4(rec[3:]): raise ValueError("counter out of range")
+    return rec
+
+# Ghi một uid, trả luôn dòng mới (không cần SELECT lại)
+SQL_PC_UPSERT = """
+  INSERT INTO scores(uid, name, rounds, kos, trainers, extra)
+  VALUES (%s,%s,%s,%s,%s,%s)
+  ON CONFLICT (uid) DO UPDATE
+    SET name = EXCLUDED.name,
+        rounds = {rounds},
+        kos = {kos},
+        trainers = {trainers},
+        extra = {extra},
+        updated_at = now()
+  RETURNING name, rounds, kos, trainers, extra
+"""
+SQL_PC_DELTA = SQL_PC_UPSERT.format(**{c: f"scores.{c} + EXCLUDED.{c}" for c in _STAT_COLS})
+SQL_PC_SET   = SQL_PC_UPSERT.format(**{c: f"EXCLUDED.{c}" for c in _STAT_COLS})
+
+# Ghi nhiều uid một lệnh: các cột truyền thành mảng song song qua unnest(),
+# uid nằm trong mảng cuối là delta (cộng dồn), còn lại là set (ghi đè)
+SQL_PC_BATCH = """
+  INSERT INTO scores(uid, name, rounds, kos, trainers, extra)
+  SELECT * FROM unnest(%s::text[], %s::text[], %s::int[], %s::int[], %s::int[], %s::int[])
+  ON CONFLICT (uid) DO UPDATE
+    SET name = EXCLUDED.name,
+        rounds = EXCLUDED.rounds + CASE WHEN scores.uid = ANY(%s::text[]) THEN scores.rounds ELSE 0 END,
+        kos = EXCLUDED.kos + CASE WHEN scores.uid = ANY(%s::text[]) THEN scores.kos ELSE 0 END,
+        trainers = EXCLUDED.trainers + CASE WHEN scores.uid = ANY(%s::text[]) THEN scores.trainers ELSE 0 END,
+        extra = EXCLUDED.extra + CASE WHEN scores.uid = ANY(%s::text[]) THEN scores.extra ELSE 0 END,
+        updated_at = now()
+  RETURNING uid, name, rounds, kos, trainers, extra
+"""
+PC_BATCH_RETRIES = 3
+
+def _coalesce_pc(records):
+    """Gộp theo uid đúng thứ tự: set thay thế, delta cộng dồn -> {uid: [action, name, r, k, t, e]}."""
+    ops = {}
+    for uid, name, action, *vals in records:
+        op = ops.get(uid)
+        if action == "delta" and op:
+            op[1] = name
+            op[2:] = [a + b for a, b in zip(op[2:], vals)]
+        else:
+            ops[uid] = ["delta" if action == "delta" else "set", name, *vals]
+    return ops
+
+def pc_apply_batch(con, ops):
+    """Ghi các thao tác đã gộp trong một transaction (một lệnh) -> {uid: dòng mới}."""
+    # Một lệnh duy nhất, dòng xếp theo (name, uid): scores khoá theo thứ tự đó và trigger
+    # board_sync khoá dòng board theo name cùng thứ tự. Đổi tên vẫn khoá thêm dòng board
+    # của tên cũ ngoài thứ tự -> có thể deadlock, khi đó thử lại cả transaction.
+    rows = sorted(((op[1], uid, *op[2:]) for uid, op in ops.items()))
+    cols = [list(col) for col in zip(*rows)]
+    deltas = [uid for uid, op in ops.items() if op[0] == "delta"]
+    for attempt in range(PC_BATCH_RETRIES):
+        try:
+            with con.transaction(), con.cursor(row_factory=dict_row) as cur:
+                cur.execute(SQL_PC_BATCH, [cols[1], cols[0], *cols[2:], *[deltas] * 4])
+                out = {r["uid"]: r for r in cur.fetchall()}
+                _rank_touch_many(cur, [(uid, r["name"]) for uid, r in out.items()])
+            return out
+        except psycopg.errors.DeadlockDetected:
+            if attempt == PC_BATCH_RETRIES - 1:
+                raise
+            log(f"[PC] deadlock, thử lại lần {attempt + 1}")
+            time.sleep(0.05 * (attempt + 1))
+
+@app.route("/api/report_batch", methods=["POST"])
+def report_pc_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        if not data:                   return jsonify(error="no data"), 400
+        if data.get("token") != TOKEN: return jsonify(error="bad token"), 401
+        items = data.get("items")
+        if not isinstance(items, list) or not items:
+            return jsonify(error="no items"), 400
+        if len(items) > BATCH_MAX:
+            return jsonify(error="too many items", max=BATCH_MAX), 413
+
+        records, errors = [], []
+        for i, item in enumerate(items):
+            try:
+                records.append(_parse_pc_item(item))
+            except (ValueError, TypeError, AttributeError) as e:
+                errors.append({"index": i, "error": "bad item", "detail": str(e)})
+        if not records:
+            return jsonify(error="no valid items", errors=errors), 400
+
+        ops = _coalesce_pc(records)
+        for uid in [uid for uid, op in ops.items() if not _in_int4(op[2:])]:
+            del ops[uid]   # từng phần tử hợp lệ nhưng cộng dồn delta thì tràn int4
+            errors.append({"uid": uid, "error": "bad item", "detail": "counter out of range after merge"})
+        if not ops:
+            return jsonify(error="no valid items", errors=errors), 400
+
+        with db_conn() as con:
+            rows = pc_apply_batch(con, ops)
+        board_invalidate()
+        results = [{"uid": uid, "name": r["name"], "rounds": r["rounds"], "kos": r["kos"],
+                    "trainers": r["trainers"], "extra": r["extra"]} for uid, r in rows.items()]
+        return jsonify(ok=True, accepted=sum(1 for r in records if r[0] in ops), results=results, errors=errors)
+    except Exception as e:
+        log(f"[PC][ERROR] {e}\n{traceback.format_exc()}")
+        return jsonify(error="internal", detail=str(e)), 500
+
 @app.route("/api/report", methods=["POST"])
 def report_pc():
     try:
@@ -56,46 +800,150 @@ def report_pc():
         if not data:                 return jsonify(error="no data"), 400
         if data.get("token") != TOKEN: return jsonify(error="bad token"), 401
 
-        action   = (data.get("action") or "set").lower()
-        name     = (data.get("name")   or "Unknown").strip()[:40]
-        uid      = (data.get("uid")    or ("__name__:"+name))
-        rounds   = int(str(data.get("rounds") or 0))
-        kos      = int(str(data.get("kos") or 0))
-        trainers = int(str(data.get("trainers") or 0))
-        extra    = int(str(data.get("extra") or 0))
-
-        with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+        uid, name, action, rounds, kos, trainers, extra = _parse_pc(data)
+        if REPORT_MODE == "buffered":
             if action == "delta":
-                cur.execute("""
-                  INSERT INTO scores(uid, name, rounds, kos, trainers, extra)
-                  VALUES (%s,%s,%s,%s,%s,%s)
-                  ON CONFLICT (uid) DO UPDATE
-                    SET name = EXCLUDED.name,
-                        rounds = scores.rounds + EXCLUDED.rounds,
-                        kos = scores.kos + EXCLUDED.kos,
-                        trainers = scores.trainers + EXCLUDED.trainers,
-                        extra = scores.extra + EXCLUDED.extra,
-                        updated_at = now()
-                """, (uid, name, rounds, kos, trainers, extra))
+                if delta_buffer_add(uid, name, (rounds, kos, trainers, extra)):
+                    return jsonify(ok=True, uid=uid, buffered=True), 202
             else:
-                cur.execute("""
-                  INSERT INTO scores(uid, name, rounds, kos, trainers, extra)
-                  VALUES (%s,%s,%s,%s,%s,%s)
-                  ON CONFLICT (uid) DO UPDATE
-                    SET name = EXCLUDED.name,
-                        rounds = EXCLUDED.rounds,
-                        kos = EXCLUDED.kos,
-                        trainers = EXCLUDED.trainers,
-                        extra = EXCLUDED.extra,
-                        updated_at = now()
-                """, (uid, name, rounds, kos, trainers, extra))
-            cur.execute("SELECT name, rounds, kos, trainers, extra FROM scores WHERE uid=%s", (uid,))
+                delta_buffer_drop(uid)   # set ghi đè -> bỏ delta cũ còn chờ
+
+        with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+            cur.execute(SQL_PC_DELTA if action == "delta" else SQL_PC_SET,
+                        (uid, name, rounds, kos, trainers, extra))
             row = cur.fetchone()
+            _rank_touch(cur, uid, name)
+        board_invalidate()
         return jsonify(ok=True, uid=uid, **row)
     except Exception as e:
         log(f"[PC][ERROR] {e}\n{traceback.format_exc()}")
         return jsonify(error="internal", detail=str(e)), 500
 
+# ========= WRITE-BEHIND (delta PC) =========
+_DELTA_BUF      = {}                  # uid -> [name, rounds, kos, trainers, extra]
+_DELTA_INFLIGHT = set()               # uid đang được flush ghi xuống DB
+_DELTA_LOCK     = threading.Lock()    # bảo vệ buffer
+_DELTA_FLUSH    = threading.Lock()    # mỗi lúc chỉ một lượt flush
+_DELTA_WAKE     = threading.Event()
+_DELTA_THREAD   = None
+_DELTA_STATS    = {"buffered": 0, "merged": 0, "overflow_sync": 0, "range_sync": 0, "flushes": 0,
+                   "flushed_rows": 0, "flush_errors": 0, "dropped": 0, "last_flush_ms": 0.0}
+
+def _delta_loop():
+    while True:
+        _DELTA_WAKE.wait(DELTA_FLUSH_SEC)
+        _DELTA_WAKE.clear()
+        try:
+            delta_flush()
+        except Exception as e:
+            log(f"[DELTA][ERROR] {e}\n{traceback.format_exc()}")
+
+def _delta_start():
+    global _DELTA_THREAD
+    if _DELTA_THREAD is None:
+        with LOCK:
+            if _DELTA_THREAD is None:
+                _DELTA_THREAD = threading.Thread(target=_delta_loop, name="delta-flush", daemon=True)
+                _DELTA_THREAD.start()
+                atexit.register(delta_flush)
+
+def delta_buffer_add(uid, name, vals):
+    """Cộng delta vào buffer; False khi buffer đầy hoặc số ngoài int4 (caller ghi đồng bộ)."""
+    with _DELTA_LOCK:
+        op = _DELTA_BUF.get(uid)
+        merged = vals if op is None else [a + b for a, b in zip(op[1:], vals)]
+        if not (_in_int4(vals) and _in_int4(merged)):
+            _DELTA_STATS["range_sync"] += 1   # để đường đồng bộ báo lỗi, không làm hỏng cả batch flush
+            return False
+        if op is None:
+            if len(_DELTA_BUF) >= DELTA_BUF_MAX:
+                _DELTA_STATS["overflow_sync"] += 1
+                return False
+            _DELTA_BUF[uid] = [name, *vals]
+            _DELTA_STATS["buffered"] += 1
+        else:
+            op[0] = name
+            op[1:] = merged
+            _DELTA_STATS["merged"] += 1
+        size = len(_DELTA_BUF)
+    _delta_start()
+    if size >= DELTA_FLUSH_UIDS:
+        _DELTA_WAKE.set()
+    return True
+
+def delta_buffer_drop(uid):
+    """Bỏ delta đang chờ của uid; nếu đang flush đúng uid đó thì chờ flush xong để giữ thứ tự."""
+    with _DELTA_LOCK:
+        _DELTA_BUF.pop(uid, None)
+        busy = uid in _DELTA_INFLIGHT
+    if busy:
+        with _DELTA_FLUSH, _DELTA_LOCK:
+            _DELTA_BUF.pop(uid, None)
+
+def _delta_requeue(items):
+    """Trả delta chưa ghi được lại buffer (cộng vào phần mới đến trong lúc flush). Gọi khi giữ _DELTA_LOCK."""
+    for uid, op in items:
+        pend = _DELTA_BUF.get(uid)
+        if pend is None:
+            _DELTA_BUF[uid] = op
+        else:
+            pend[1:] = [a + b for a, b in zip(pend[1:], op[1:])]
+
+def _delta_flush_each(con, batch):
+    """Batch lỗi dữ liệu (vd. cộng vào tổng trong DB thì tràn int4): ghi lại từng uid,
+    uid lỗi dữ liệu thì bỏ + log. Uid đã xử lý được xoá khỏi batch -> lỗi khác (mất kết nối...)
+    bay ra thì batch chỉ còn phần chưa ghi. Trả số uid bị bỏ."""
+    dropped = 0
+    for uid in list(batch):
+        try:
+            pc_apply_batch(con, {uid: ["delta", *batch[uid]]})
+        except psycopg.errors.DataError as e:
+            log(f"[DELTA][DROP] uid={uid} delta={batch[uid][1:]}: {e}")
+            dropped += 1
+        del batch[uid]
+    return dropped
+
+def delta_flush():
+    """Ghi toàn bộ delta đang chờ bằng một batch; lỗi dữ liệu thì cô lập từng uid,
+    lỗi khác thì trả lại buffer để thử lần sau."""
+    with _DELTA_FLUSH:
+        with _DELTA_LOCK:
+            if not _DELTA_BUF:
+                return 0
+            batch = dict(_DELTA_BUF)
+            _DELTA_BUF.clear()
+            _DELTA_INFLIGHT.update(batch)
+        t0, n, dropped = time.perf_counter(), len(batch), 0
+        try:
+            with db_conn() as con:
+                try:
+                    pc_apply_batch(con, {uid: ["delta", *op] for uid, op in batch.items()})
+                except psycopg.errors.DataError:
+                    with _DELTA_LOCK:
+                        _DELTA_STATS["flush_errors"] += 1
+                    dropped = _delta_flush_each(con, batch)
+        except Exception:
+            with _DELTA_LOCK:
+                _DELTA_STATS["flush_errors"] += 1
+                _delta_requeue(batch.items())
+            raise
+        finally:
+            with _DELTA_LOCK:
+                _DELTA_INFLIGHT.clear()
+        with _DELTA_LOCK:
+            _DELTA_STATS["flushes"] += 1
+            _DELTA_STATS["flushed_rows"] += n - dropped
+            _DELTA_STATS["dropped"] += dropped
+            _DELTA_STATS["last_flush_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        board_invalidate()
+        return n - dropped
+
+@app.route("/api/buffer_stats")
+def buffer_stats():
+    if (request.args.get("token") or "") != TOKEN: return jsonify(error="bad token"), 401
+    with _DELTA_LOCK:
+        return jsonify(ok=True, mode=REPORT_MODE, pid=os.getpid(), pending=len(_DELTA_BUF), **_DELTA_STATS)
+
 # ========= ANDROID UPLOAD (bytes-safe) =========
 def _parse_bxh_file(raw_bytes):
     """Nhận .bxh base64(JSON) hoặc JSON thô -> dict (giữ nguyên bytes)."""
@@ -125,72 +973,293 @@ def _calc_sig(p):
     digest = hashlib.sha1 if alg == "sha1" else hashlib.sha256
     return hmac.new(UPLOAD_KEY.encode("ascii"), _msg_bytes(p), digest).hexdigest()
 
+def _verify_bxh(data):
+    """Kiểm chữ ký HMAC -> None nếu hợp lệ, ngược lại mã lỗi."""
+    sig_client = str(data.get("sig",""))
+    if not sig_client: return "missing sig"
+    if not hmac.compare_digest(sig_client, _calc_sig(data)): return "bad signature"
+    return None
+
+def _parse_android(data):
+    return {
+        "uid":      str(data.get("uid") or "").strip(),
+        "name":     (data.get("name") or "Unknown").strip()[:40],
+        "action":   (data.get("action") or "delta").lower(),
+        "rounds":   int(str(data.get("rounds") or 0)),
+        "kos":      int(str(data.get("kos") or 0)),
+        "trainers": int(str(data.get("trainers") or 0)),
+        "extra":    int(str(data.get("extra") or 0)),
+        "ts":       int(str(data.get("ts") or 0)),
+        "sig":      str(data.get("sig","")),
+    }
+
+# Chống replay ngay trong lệnh upsert: chỉ ghi khi ts mới hơn, hoặc cùng ts nhưng khác chữ ký.
+# Điều kiện xét trên dòng đã khoá nên 2 upload cùng uid không thể cùng lọt; `prev` (snapshot
+# trước lệnh) chỉ là giá trị dự phòng, bị từ chối thì luôn đọc lại (SQL_ANDROID_LAST).
+SQL_ANDROID_UPSERT = """
+  WITH prev AS (
+    SELECT last_ts, last_sig FROM android_scores WHERE uid = %(uid)s
+  ), up AS (
+    INSERT INTO android_scores(uid, name, rounds, kos, trainers, extra, last_ts, last_sig)
+    VALUES (%(uid)s, %(name)s, %(rounds)s, %(kos)s, %(trainers)s, %(extra)s, %(ts)s, %(sig)s)
+    ON CONFLICT (uid) DO UPDATE
+      SET name = EXCLUDED.name,
+          rounds = {rounds},
+          kos = {kos},
+          trainers = {trainers},
+          extra = {extra},
+          last_ts = GREATEST(android_scores.last_ts, EXCLUDED.last_ts),
+          last_sig = EXCLUDED.last_sig,
+          updated_at = now()
+      WHERE EXCLUDED.last_ts > android_scores.last_ts
+         OR (EXCLUDED.last_ts = android_scores.last_ts AND EXCLUDED.last_sig <> android_scores.last_sig)
+    RETURNING 1
+  )
+  SELECT EXISTS (SELECT 1 FROM up)     AS applied,
+         (SELECT last_ts  FROM prev)   AS last_ts,
+         (SELECT last_sig FROM prev)   AS last_sig
+"""
+SQL_ANDROID_DELTA = SQL_ANDROID_UPSERT.format(**{c: f"android_scores.{c} + EXCLUDED.{c}" for c in _STAT_COLS})
+SQL_ANDROID_SET   = SQL_ANDROID_UPSERT.format(**{c: f"EXCLUDED.{c}" for c in _STAT_COLS})
+
+# Không ghi được: prev là snapshot lúc lệnh bắt đầu, còn ON CONFLICT so với bản mới nhất
+# (request khác có thể vừa chèn / ghi uid này) -> đọc lại last_ts/last_sig hiện tại rồi mới
+# phân loại stale / duplicate
+SQL_ANDROID_LAST = "SELECT last_ts, last_sig FROM android_scores WHERE uid = %(uid)s"
+
+def _android_recheck(row):
+    return not row["applied"]
+
+def _android_outcome(row, rec):
+    if row["applied"]:
+        return "ok"
+    if row["last_ts"] is not None and rec["ts"] < row["last_ts"]:
+        return "stale"
+    if rec["ts"] == row["last_ts"] and rec["sig"] == row["last_sig"]:
+        return "duplicate"
+    return "stale"   # lúc đọc lại, một upload khác (cùng ts, khác chữ ký) đã ghi đè bản này
+
+def _android_classify(cur, row, rec):
+    if _android_recheck(row):
+        cur.execute(SQL_ANDROID_LAST, rec)
+        row = {**row, **(cur.fetchone() or {})}
+    return _android_outcome(row, rec)
+
+def android_apply(con, rec):
+    """Ghi một bản .bxh đã xác thực -> "ok" | "stale" | "duplicate".
+    Chỉ cập nhật chỉ mục thứ hạng khi thật sự ghi (bản cũ / trùng không được đổi uid -> tên)."""
+    sql = SQL_ANDROID_DELTA if rec["action"] == "delta" else SQL_ANDROID_SET
+    with con.cursor(row_factory=dict_row) as cur:
+        cur.execute(sql, rec)
+        outcome = _android_classify(cur, cur.fetchone(), rec)
+        if outcome == "ok":
+            _rank_touch(cur, rec["uid"], rec["name"])
+    return outcome
+
+_SEEN = OrderedDict()    # (uid, ts, sig) -> lúc nhận
+_SEEN_LOCK = threading.Lock()
+
+def android_seen(rec, add=False):
+    """True nếu (uid, ts, sig) đã nhận trong ANDROID_SEEN_TTL giây; add=True để ghi nhớ."""
+    key, now = (rec["uid"], rec["ts"], rec["sig"]), time.monotonic()
+    with _SEEN_LOCK:
+        if add:
+            _SEEN[key] = now
+            _SEEN.move_to_end(key)
+            while len(_SEEN) > ANDROID_SEEN_MAX:
+                _SEEN.popitem(last=False)
+            return True
+        at = _SEEN.get(key)
+        return at is not None and now - at < ANDROID_SEEN_TTL
+
 @app.route("/api/upload_android", methods=["POST"])
 def upload_android():
     try:
         f = request.files.get("file")
-        if not f: return jsonify(error="no file"), 400
+        if not f:
+            M_UPLOADS.inc("single", "no file")
+            return jsonify(error="no file"), 400
         data = _parse_bxh_file(f.read())
 
         # Verify
-        sig_client = str(data.get("sig",""))
-        if not sig_client: return jsonify(error="missing sig"), 400
-        sig_server = _calc_sig(data)
-        if not hmac.compare_digest(sig_client, sig_server):
-            return jsonify(error="bad signature"), 401
-
-        uid      = str(data.get("uid") or "").strip()
-        name     = (data.get("name") or "Unknown").strip()[:40]
-        action   = (data.get("action") or "delta").lower()
-        rounds   = int(str(data.get("rounds") or 0))
-        kos      = int(str(data.get("kos") or 0))
-        trainers = int(str(data.get("trainers") or 0))
-        extra    = int(str(data.get("extra") or 0))
-        ts       = int(str(data.get("ts") or 0))
+        err = _verify_bxh(data)
+        if err:
+            M_UPLOADS.inc("single", err)
+            return jsonify(error=err), (400 if err == "missing sig" else 401)
+        rec = _parse_android(data)
 
-        with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
-            # chống replay theo timestamp
-            cur.execute("SELECT last_ts, last_sig FROM android_scores WHERE uid=%s", (uid,))
-            row = cur.fetchone()
-            if row:
-                last_ts  = int(row["last_ts"] or 0)
-                last_sig = row["last_sig"] or ""
-                if ts < last_ts:
-                    return jsonify(error="stale", detail="older timestamp"), 409
-                if ts == last_ts and sig_client == last_sig:
-                    return jsonify(error="duplicate", detail="same payload"), 409
-
-            if action == "delta":
-                cur.execute("""
-                  INSERT INTO android_scores(uid, name, rounds, kos, trainers, extra, last_ts, last_sig)
-                  VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                  ON CONFLICT (uid) DO UPDATE
-                    SET name = EXCLUDED.name,
-                        rounds = android_scores.rounds + EXCLUDED.rounds,
-                        kos = android_scores.kos + EXCLUDED.kos,
-                        trainers = android_scores.trainers + EXCLUDED.trainers,
-                        extra = android_scores.extra + EXCLUDED.extra,
-                        last_ts = GREATEST(android_scores.last_ts, EXCLUDED.last_ts),
-                        last_sig = EXCLUDED.last_sig,
-                        updated_at = now()
-                """, (uid, name, rounds, kos, trainers, extra, ts, sig_client))
-            else:
-                cur.execute("""
-                  INSERT INTO android_scores(uid, name, rounds, kos, trainers, extra, last_ts, last_sig)
-                  VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                  ON CONFLICT (uid) DO UPDATE
-                    SET name = EXCLUDED.name,
-                        rounds = EXCLUDED.rounds,
-                        kos = EXCLUDED.kos,
-                        trainers = EXCLUDED.trainers,
-                        extra = EXCLUDED.extra,
-                        last_ts = GREATEST(android_scores.last_ts, EXCLUDED.last_ts),
-                        last_sig = EXCLUDED.last_sig,
-                        updated_at = now()
-                """, (uid, name, rounds, kos, trainers, extra, ts, sig_client))
+        # chống replay: LRU trong RAM trước, rồi điều kiện ngay trong lệnh upsert
+        if android_seen(rec):
+            M_UPLOADS.inc("single", "duplicate")
+            return jsonify(error="duplicate", detail="same payload"), 409
+        with db_conn() as con:
+            outcome = android_apply(con, rec)
+        M_UPLOADS.inc("single", outcome)
+        if outcome != "stale":
+            android_seen(rec, add=True)
+        if outcome == "stale":
+            return jsonify(error="stale", detail="older timestamp"), 409
+        if outcome == "duplicate":
+            return jsonify(error="duplicate", detail="same payload"), 409
 
+        board_invalidate()
         # Thành công -> chuyển ngay về BXH all
         return redirect(url_for("board_all"), code=303)
+    except Exception as e:
+        M_UPLOADS.inc("single", "error")
+        log(f"[ANDROID][ERROR] {e}\n{traceback.format_exc()}")
+        return jsonify(error="internal", detail=str(e)), 500
+
+# ========= ANDROID BULK UPLOAD (nhiều file / zip) =========
+_BULK_POOL = None
+
+def _bulk_pool():
+    global _BULK_POOL
+    if _BULK_POOL is None:
+        with LOCK:
+            if _BULK_POOL is None:
+                _BULK_POOL = ThreadPoolExecutor(max_workers=BULK_WORKERS, thread_name_prefix="bxh-verify")
+    return _BULK_POOL
+
+def _bulk_entries(files):
+    """Duyệt lần lượt từng file / từng entry zip -> (nhãn, bytes hoặc None, lỗi hoặc None).
+    Entry zip được đọc riêng từng cái (tối đa BULK_MAX_ENTRY byte), không giải nén cả archive."""
+    count = 0
+    for f in files:
+        fname = f.filename or "file"
+        head = f.stream.read(4)
+        f.stream.seek(0)
+        if head != b"PK\x03\x04":
+            count += 1
+            if count > BULK_MAX_FILES:
+                yield fname, None, "too many files"
+                return
+            yield fname, f.stream.read(BULK_MAX_ENTRY + 1), None
+            continue
+        try:
+            zf = zipfile.ZipFile(f.stream)
+        except (zipfile.BadZipFile, OSError, EOFError):
+            yield fname, None, "bad zip"
+            continue
+        with zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                count += 1
+                label = f"{fname}/{info.filename}"
+                if count > BULK_MAX_FILES:
+                    yield label, None, "too many files"
+                    return
+                if info.file_size > BULK_MAX_ENTRY:
+                    yield label, None, "too large"
+                    continue
+                # entry hỏng (deflate lỗi, CRC sai, bị cắt...) chỉ làm hỏng chính nó, không cả báo cáo
+                try:
+                    with zf.open(info) as zfh:
+                        raw = zfh.read(BULK_MAX_ENTRY + 1)
+                except (zipfile.BadZipFile, NotImplementedError, RuntimeError, zlib.error, OSError, EOFError):
+                    yield label, None, "bad zip entry"
+                    continue
+                yield label, raw, None
+
+def _bulk_decode(entry):
+    """Chạy trong worker pool: giải mã + kiểm HMAC một file -> (nhãn, rec, lỗi)."""
+    label, raw, err = entry
+    if err:
+        return label, None, err
+    if len(raw) > BULK_MAX_ENTRY:
+        return label, None, "too large"
+    try:
+        data = _parse_bxh_file(raw)
+        err = _verify_bxh(data)
+        if err:
+            return label, None, err
+        rec = _parse_android(data)
+        if not _in_int4(rec[c] for c in _STAT_COLS):
+            return label, None, "counter out of range"
+        return label, rec, None
+    except Exception:
+        return label, None, "bad file"
+
+def _bulk_map(fn, items, window):
+    """pool.map nhưng chỉ giữ tối đa `window` việc đang chạy (không đọc trước cả archive)."""
+    pool, pending = _bulk_pool(), deque()
+    for it in items:
+        pending.append(pool.submit(fn, it))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def android_apply_many(con, recs):
+    """Ghi nhiều bản .bxh trong một transaction, theo thứ tự (uid, ts); mọi lệnh đi chung
+    pipeline. Trả outcome theo đúng thứ tự `recs` đã sắp.
+    Một bản làm tràn int4 khi cộng vào tổng trong DB thì ghi lại từng bản trong savepoint
+    riêng để chỉ bản đó bị báo "counter out of range"."""
+    try:
+        return _android_apply_pipelined(con, recs)
+    except psycopg.errors.DataError:
+        pass
+    outcomes = []
+    with con.transaction(), con.cursor(row_factory=dict_row) as cur:
+        for rec in recs:
+            try:
+                with con.transaction():
+                    cur.execute(SQL_ANDROID_DELTA if rec["action"] == "delta" else SQL_ANDROID_SET, rec)
+                    outcomes.append(_android_classify(cur, cur.fetchone(), rec))
+            except psycopg.errors.DataError as e:
+                log(f"[ANDROID] uid={rec['uid']} ts={rec['ts']}: {e}")
+                outcomes.append("counter out of range")
+        _rank_touch_many(cur, [(r["uid"], r["name"]) for r, o in zip(recs, outcomes) if o == "ok"])
+    return outcomes
+
+def _android_apply_pipelined(con, recs):
+    with con.transaction(), con.pipeline():
+        curs = []
+        for rec in recs:
+            cur = con.cursor(row_factory=dict_row)
+            cur.execute(SQL_ANDROID_DELTA if rec["action"] == "delta" else SQL_ANDROID_SET, rec)
+            curs.append(cur)
+        outcomes = [_android_classify(cur, cur.fetchone(), rec) for cur, rec in zip(curs, recs)]
+        with con.cursor(row_factory=dict_row) as cur:
+            _rank_touch_many(cur, [(r["uid"], r["name"]) for r, o in zip(recs, outcomes) if o == "ok"])
+    return outcomes
+
+@app.route("/api/upload_android_bulk", methods=["POST"])
+def upload_android_bulk():
+    try:
+        files = request.files.getlist("files") + request.files.getlist("file")
+        if not files: return jsonify(error="no file"), 400
+
+        results, valid = [], []
+        for label, rec, err in _bulk_map(_bulk_decode, _bulk_entries(files), 2 * BULK_WORKERS):
+            if err or rec is None:
+                results.append({"file": label, "status": err or "bad file"})
+                continue
+            res = {"file": label, "uid": rec["uid"], "ts": rec["ts"]}
+            results.append(res)
+            if android_seen(rec):
+                res["status"] = "duplicate"
+            else:
+                valid.append((rec, res))
+
+        if valid:
+            valid.sort(key=lambda v: (v[0]["uid"], v[0]["ts"]))
+            with db_conn() as con:
+                outcomes = android_apply_many(con, [rec for rec, _ in valid])
+            for (rec, res), outcome in zip(valid, outcomes):
+                res["status"] = outcome
+                if outcome in ("ok", "duplicate"):
+                    android_seen(rec, add=True)
+            if "ok" in outcomes:
+                board_invalidate()
+
+        counts = {}
+        for r in results:
+            counts[r["status"]] = counts.get(r["status"], 0) + 1
+        for status, n in counts.items():
+            M_UPLOADS.inc("bulk", status, by=n)
+        return jsonify(ok=True, counts=counts, results=results)
     except Exception as e:
         log(f"[ANDROID][ERROR] {e}\n{traceback.format_exc()}")
         return jsonify(error="internal", detail=str(e)), 500
@@ -236,6 +1305,8 @@ table{width:100%;border-collapse:separate;border-spacing:0}
 th,td{padding:12px 14px;border-bottom:1px solid var(--border);white-space:nowrap}
 th{position:sticky;top:0;background:var(--card);z-index:1;font-size:13px;color:var(--muted);text-transform:uppercase;letter-spacing:.08em}
 tbody tr:nth-child(even){background:var(--row)}
+tbody tr.live{animation:live 1.5s ease-out}
+@keyframes live{from{background:rgba(255,204,0,.22)}}
 .rank{text-align:center;font-weight:800}
 .badge{display:inline-flex;align-items:center;gap:6px;padding:2px 8px;border-radius:999px;border:1px solid var(--border);font-variant-numeric:tabular-nums;background:#0b1222}
 .footer{display:flex;justify-content:space-between;align-items:center;padding:12px 16px;color:var(--muted);font-size:13px}
@@ -282,7 +1353,7 @@ tbody tr:nth-child(even){background:var(--row)}
       </div>
     </div>
     <div class="table-wrap">
-      <table id="board">
+      <table id="board" data-page="{{ page }}">
       <colgroup>
           <col style="width:72px">   <!-- # -->
           <col>                       <!-- Tên (auto) -->
@@ -303,7 +1374,7 @@ tbody tr:nth-child(even){background:var(--row)}
       </thead>
         <tbody>
         {% for name, row in rows %}
-          <tr data-name="{{ name|lower }}" data-rounds="{{ row.rounds }}" data-kos="{{ row.kos }}" data-trainers="{{ row.trainers }}" data-extra="{{ row.extra }}">
+          <tr data-key="{{ name }}" data-name="{{ name|lower }}" data-rounds="{{ row.rounds }}" data-kos="{{ row.kos }}" data-trainers="{{ row.trainers }}" data-extra="{{ row.extra }}">
             <td class="rank"><span class="badge">{{ loop.index }}</span></td>
             <td class="name">{{ name }}</td>
             <td class="num">{{ row.rounds }}</td>
@@ -315,31 +1386,76 @@ tbody tr:nth-child(even){background:var(--row)}
         </tbody>
       </table>
     </div>
-    <div class="footer"><span>Hiển thị {{ rows|length }} người chơi</span><span id="updatedAt">⏱️</span></div>
+    <div class="footer"><span>Hiển thị <span id="shown">{{ state.shown }}</span>/{{ state.total }} người chơi <button id="btnMore" data-next="{{ state.next or '' }}" {% if not state.next %}hidden{% endif %}>Xem thêm</button></span><span id="updatedAt">⏱️</span></div>
   </div>
 </div>
 <script>
-const q=document.getElementById('q');
-q?.addEventListener('input',()=>{const t=q.value.toLowerCase();document.querySelectorAll('#board tbody tr').forEach(tr=>{tr.style.display=tr.dataset.name.includes(t)?'':'none';});});
-const sortBy=document.getElementById('sortBy');
-function sortTable(mode){
-  const tbody=document.querySelector('#board tbody');
-  const rows=[...tbody.querySelectorAll('tr')];
-  const keyDefault = r=>[+(r.dataset.trainers||0),+(r.dataset.kos||0),+(r.dataset.rounds||0),+(r.dataset.extra||0)];
-  const keyKos     = r=>[+(r.dataset.kos||0),+(r.dataset.trainers||0),+(r.dataset.rounds||0),+(r.dataset.extra||0)];
-  const keyRounds  = r=>[+(r.dataset.rounds||0),+(r.dataset.trainers||0),+(r.dataset.kos||0),+(r.dataset.extra||0)];
-  const keyExtra   = r=>[+(r.dataset.extra||0),+(r.dataset.trainers||0),+(r.dataset.kos||0),+(r.dataset.rounds||0)];
-  const getKey = r => (mode==='kos'?keyKos(r):mode==='rounds'?keyRounds(r):mode==='extra'?keyExtra(r):keyDefault(r));
-  rows.sort((a,b)=>{const ka=getKey(a),kb=getKey(b);for(let i=0;i<ka.length;i++){if(kb[i]!==ka[i]) return kb[i]-ka[i];}return a.dataset.name.localeCompare(b.dataset.name);});
-  rows.forEach((r,i)=>{r.querySelector('.badge').textContent=(i+1);tbody.appendChild(r);});
+// Tìm kiếm / sắp xếp / xem thêm đều hỏi server (/api/leaderboard), không sort cả bảng trên trình duyệt
+const q=document.getElementById('q'), sortBy=document.getElementById('sortBy'), more=document.getElementById('btnMore');
+const board=document.getElementById('board'), tbody=board.querySelector('tbody'), shown=document.getElementById('shown');
+let next=more.dataset.next||'', seq=0;
+function td(cls,text){const c=document.createElement('td');c.className=cls;c.textContent=text;return c;}
+function rowEl(r){
+  const tr=document.createElement('tr');
+  tr.dataset.key=r.name;tr.dataset.name=r.name.toLowerCase();tr.dataset.rounds=r.rounds;tr.dataset.kos=r.kos;tr.dataset.trainers=r.trainers;tr.dataset.extra=r.extra;
+  const rank=td('rank','');const b=document.createElement('span');b.className='badge';b.textContent=r.pos;rank.appendChild(b);
+  tr.append(rank,td('name',r.name),td('num',r.rounds),td('num',r.kos),td('num',r.trainers),td('num',r.extra));
+  return tr;
+}
+async function loadPage(reset){
+  const my=++seq, p=new URLSearchParams({sort:sortBy.value,limit:board.dataset.page});
+  if(q.value.trim()) p.set('q',q.value.trim());
+  if(!reset&&next) p.set('after',next);
+  const res=await fetch('/api/leaderboard?'+p); if(!res.ok||my!==seq) return;
+  const j=await res.json(); if(my!==seq) return;
+  if(reset) tbody.replaceChildren();
+  j.rows.forEach(r=>tbody.appendChild(rowEl(r)));
+  next=j.next||''; more.hidden=!next; shown.textContent=tbody.rows.length;
+}
+let qTimer; q?.addEventListener('input',()=>{clearTimeout(qTimer);qTimer=setTimeout(()=>loadPage(true),250);});
+sortBy?.addEventListener('change',()=>loadPage(true));
+more?.addEventListener('click',()=>loadPage(false));
+// Live: server đẩy các dòng vừa đổi + thứ hạng mới (chỉ áp vào chế độ mặc định, không lọc)
+function applyLive(ev){
+  const live=sortBy.value==='default'&&!q.value.trim();
+  if(ev.reset){ if(live) loadPage(true); return; }
+  if(!live) return;
+  const byKey=new Map([...tbody.rows].map(tr=>[tr.dataset.key,tr]));
+  ev.removed.forEach(n=>byKey.get(n)?.remove());
+  ev.rows.forEach(r=>byKey.get(r.name)?.remove());
+  ev.rows.sort((a,b)=>a.rank-b.rank).forEach(r=>{
+    const i=r.rank-1; if(i>tbody.rows.length||(i===tbody.rows.length&&next)) return;   // ngoài phần đã tải
+    const tr=rowEl({...r,pos:r.rank}); tr.className='live'; tbody.insertBefore(tr,tbody.rows[i]||null);
+  });
+  [...tbody.rows].forEach((tr,i)=>tr.querySelector('.badge').textContent=i+1);
+  shown.textContent=tbody.rows.length;
+}
+// Không có SSE (server đầy trả 204, hoặc trình duyệt không hỗ trợ) -> tải lại trang đầu định kỳ
+let polling=false;
+function livePoll(){
+  if(polling) return; polling=true;
+  setInterval(()=>{ if(!document.hidden&&tbody.rows.length<=+board.dataset.page) applyLive({reset:true}); },{{ live_poll }}*1000);
 }
-sortBy?.addEventListener('change',()=>sortTable(sortBy.value));
+if(window.EventSource){
+  const es=new EventSource('/api/live');
+  es.onmessage=e=>applyLive(JSON.parse(e.data));
+  es.onerror=()=>{ if(es.readyState===EventSource.CLOSED) livePoll(); };
+} else livePoll();
 // Clock
 function pad(n){return n<10?'0'+n:n} ; function tick(){const d=new Date();document.getElementById('updatedAt').textContent=`⏱️ Cập nhật: ${pad(d.getHours())}:${pad(d.getMinutes())}:${pad(d.getSeconds())}`;}
 tick(); setInterval(tick,1000);
 </script>
 """
 
+# compile một lần lúc khởi động thay vì mỗi request
+TPL_ALL = app.jinja_env.from_string(TPL_BASE)
+
+# templates/board_babel.html chưa có route render (cần Flask-Babel), nạp sẵn vào cache của jinja
+try:
+    app.jinja_env.get_template("board_babel.html")
+except TemplateError as e:
+    log(f"[TPL][ERROR] board_babel.html: {e}")
+
 def _rows_from(cur, table):
     cur.execute(f"SELECT name, rounds, kos, trainers, extra FROM {table}")
     items = cur.fetchall()
@@ -350,44 +1466,174 @@ def _rows_from(cur, table):
     )
     return rows
 
-# Gộp PC + Android
-def _rows_all(cur):
-    cur.execute("""
-      WITH u AS (
-        SELECT name, rounds, kos, trainers, extra FROM scores
-        UNION ALL
-        SELECT name, rounds, kos, trainers, extra FROM android_scores
-      )
-      SELECT name,
-             SUM(rounds)   AS rounds,
-             SUM(kos)      AS kos,
-             SUM(trainers) AS trainers,
-             SUM(extra)    AS extra
-      FROM u
-      GROUP BY name
-    """)
-    items = cur.fetchall()
-    rows = sorted(
-        [(r["name"], {
-            "rounds":   int(r["rounds"] or 0),
-            "kos":      int(r["kos"] or 0),
-            "trainers": int(r["trainers"] or 0),
-            "extra":    int(r["extra"] or 0),
-        }) for r in items],
-        key=lambda kv: (kv[1]["trainers"], kv[1]["kos"], kv[1]["rounds"], kv[1]["extra"]),
-        reverse=True
-    )
-    return rows
+# Keyset pagination: cursor = khoá sắp xếp của dòng cuối + tên + số dòng đã trả
+def _cursor_encode(row, keys, pos):
+    raw = json.dumps([*(int(row[k]) for k in keys), row["name"], pos], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _cursor_decode(s):
+    try:
+        v = json.loads(base64.urlsafe_b64decode(s + "=" * (-len(s) % 4)))
+        return [int(x) for x in v[:4]], str(v[4]), int(v[5])
+    except Exception:
+        raise ValueError("bad cursor")
+
+def _board_iter(cur, state, sort="default", q="", match="contains", after=None, limit=BOARD_PAGE, season=None):
+    """Sinh dần các dòng một trang BXH theo `sort`, lọc tên theo `q`; duyệt xong thì
+    state["next"] = cursor trang sau (hoặc None), state["shown"] = số dòng đã sinh.
+    `cur` có thể là server-side cursor: chỉ đọc từng đợt itersize dòng.
+    `season` = id mùa đã lưu -> đọc season_board thay cho board đang chạy."""
+    keys = BOARD_SORTS[sort]
+    cols = ", ".join(keys)
+    where, args, pos = [], [], 0
+    if season is not None:
+        where.append("season_id = %s")
+        args.append(season)
+    if q:
+        pat = q.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("lower(name) LIKE %s")
+        args.append(pat + "%" if match == "prefix" else "%" + pat + "%")
+    if after:
+        vals, last_name, pos = _cursor_decode(after)
+        # (<=) cho index range scan, phần OR tách các dòng hoà khoá theo tên
+        where.append(f"({cols}) <= (%s,%s,%s,%s) AND (({cols}) < (%s,%s,%s,%s) OR name > %s)")
+        args += vals + vals + [last_name]
+    cur.execute(f"""
+      SELECT name, rounds, kos, trainers, extra
+      FROM {"board" if season is None else "season_board"}
+      {"WHERE " + " AND ".join(where) if where else ""}
+      ORDER BY {", ".join(k + " DESC" for k in keys)}, name
+      LIMIT %s
+    """, args + [limit + 1])
+    state["next"], state["shown"], prev = None, 0, None
+    for i, r in enumerate(cur, pos + 1):
+        if i > pos + limit:
+            state["next"] = _cursor_encode(prev, keys, pos + limit)
+            break
+        prev = r
+        state["shown"] += 1
+        yield {"pos": i, "name": r["name"], "rounds": int(r["rounds"]), "kos": int(r["kos"]),
+               "trainers": int(r["trainers"]), "extra": int(r["extra"])}
+
+def _board_page(cur, sort="default", q="", match="contains", after=None, limit=BOARD_PAGE, season=None):
+    """Một trang BXH -> (rows, cursor trang sau hoặc None)."""
+    state = {}
+    rows = list(_board_iter(cur, state, sort, q, match, after, limit, season))
+    return rows, state["next"]
+
+@app.route("/api/leaderboard")
+def api_leaderboard():
+    sort  = request.args.get("sort") or "default"
+    if sort not in BOARD_SORTS: return jsonify(error="bad sort"), 400
+    q     = (request.args.get("q") or "").strip()[:40]
+    match = "prefix" if request.args.get("match") == "prefix" else "contains"
+    try:
+        limit = min(max(int(request.args.get("limit") or BOARD_PAGE), 1), BOARD_PAGE_MAX)
+        season = _season_arg()
+        with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+            rows, nxt = _board_page(cur, sort, q, match, request.args.get("after"), limit, season)
+    except ValueError as e:
+        return jsonify(error="bad request", detail=str(e)), 400
+    return jsonify(ok=True, sort=sort, season=season, rows=rows, next=nxt)
 
 @app.route("/")
 def home():
     return redirect(url_for("board_all"))
 
+# ========= CACHE BXH =========
+# version tăng mỗi lần ghi; snapshot chỉ dùng lại khi cùng version và chưa quá TTL
+_BOARD = {"version": 0, "built": -1, "at": 0.0, "body": None, "etag": None}
+_BOARD_BUILD = threading.Lock()
+
+def board_invalidate():
+    with LOCK:
+        _BOARD["version"] += 1
+    history_prune_maybe()   # mọi đường ghi đều đi qua đây
+
+def _board_fresh():
+    return (_BOARD["body"] is not None and _BOARD["built"] == _BOARD["version"]
+            and time.monotonic() - _BOARD["at"] < BOARD_CACHE_TTL)
+
+def _board_store(version, body):
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+    with LOCK:
+        _BOARD.update(built=version, at=time.monotonic(), body=body, etag=etag)
+    return etag
+
+def _board_chunks(con):
+    """Các khúc HTML của /all từ template đã compile sẵn; dòng BXH đọc dần qua server-side
+    cursor (con phải đang trong transaction), tổng số người chơi đọc sau cùng cho footer."""
+    state = {"next": None, "shown": 0, "total": 0}
+    def rows():
+        with con.cursor(name="board_all", row_factory=dict_row) as cur:
+            cur.itersize = 200
+            for r in _board_iter(cur, state):
+                yield r["name"], r
+        state["total"] = con.execute("SELECT count(*) FROM board").fetchone()[0]
+    ctx = {"title": "BXH Pokémon Việt Nam — ALL", "rows": rows(), "state": state,
+           "page": BOARD_PAGE, "live_poll": LIVE_POLL, "show_upload": True}
+    app.update_template_context(ctx)
+    stream = TPL_ALL.stream(ctx)
+    stream.enable_buffering(64)
+    return stream
+
+def board_snapshot(wait=None):
+    """(body, etag) của trang /all; chỉ một thread dựng lại, các thread khác chờ rồi dùng chung.
+    `wait` = số giây chờ tối đa; quá hạn (thread đang dựng bị client chậm giữ) thì tự dựng."""
+    if _board_fresh():
+        return _BOARD["body"], _BOARD["etag"]
+    locked = _BOARD_BUILD.acquire(timeout=-1 if wait is None else wait)
+    try:
+        if _board_fresh():
+            return _BOARD["body"], _BOARD["etag"]
+        version = _BOARD["version"]
+        with db_conn() as con, con.transaction():
+            body = "".join(_board_chunks(con))
+        return body, _board_store(version, body)
+    finally:
+        if locked:
+            _BOARD_BUILD.release()
+
+def _board_cached_response(body, etag):
+    resp = make_response(body)
+    resp.set_etag(etag)                          # strong ETag -> "↻ Tải lại" nhận 304 nếu không đổi
+    resp.headers["Cache-Control"] = "no-cache"   # luôn hỏi lại server, không dùng bản cũ
+    return resp.make_conditional(request)
+
 @app.route("/all")
 def board_all():
-    with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
-        rows = _rows_all(cur)
-    return render_template_string(TPL_BASE, title="BXH Pokémon Việt Nam — ALL", rows=rows, show_upload=True)
+    if _board_fresh():
+        return _board_cached_response(_BOARD["body"], _BOARD["etag"])
+    # cache nguội: chỉ thread giữ _BOARD_BUILD stream từ DB (và lưu lại bản HTML);
+    # các request cùng lúc chờ bản đó như board_snapshot() thay vì mở cursor riêng
+    if not _BOARD_BUILD.acquire(blocking=False):
+        return _board_cached_response(*board_snapshot(wait=BOARD_BUILD_WAIT))
+    if _board_fresh():
+        _BOARD_BUILD.release()
+        return _board_cached_response(_BOARD["body"], _BOARD["etag"])
+
+    held = True
+    def release():
+        # gọi khi stream xong, lỗi, hoặc server đóng response (HEAD, client ngắt sớm)
+        nonlocal held
+        if held:
+            held = False
+            _BOARD_BUILD.release()
+    version = _BOARD["version"]
+    def gen():
+        try:
+            parts = []
+            with db_conn() as con, con.transaction():
+                for chunk in _board_chunks(con):
+                    parts.append(chunk)
+                    yield chunk
+            _board_store(version, "".join(parts))
+        finally:
+            release()
+    resp = Response(stream_with_context(gen()), mimetype="text/html")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.call_on_close(release)
+    return resp
 
 # Giữ route cũ nhưng chuyển hướng để không nhầm
 @app.route("/pc")
@@ -403,17 +1649,152 @@ def board_android_redirect():
 def static_files(fname):
     return send_from_directory("static", fname)
 
+# ========= LIVE (SSE) =========
+_LIVE_SUBS   = set()          # queue.Queue của từng kết nối SSE trong worker này
+_LIVE_LOCK   = threading.Lock()
+_LIVE_THREAD = None
+
+def _live_broadcast(ev):
+    with _LIVE_LOCK:
+        subs = list(_LIVE_SUBS)
+    for q in subs:
+        try:
+            q.put_nowait(ev)
+        except queue.Full:
+            # client quá chậm: bỏ các lô đang chờ, bảo nó tải lại trang đầu
+            with q.mutex:
+                q.queue.clear()
+            q.put_nowait({"reset": True})
+
+def _live_flush(con, names):
+    """Đọc lại các dòng board vừa đổi, cập nhật chỉ mục thứ hạng + cache rồi đẩy một lô."""
+    board_invalidate()
+    if "*" in names:
+        rank_reload()
+        _live_broadcast({"reset": True})
+        return
+    rank_ensure_fresh()
+    names = list(names)
+    with con.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT name, rounds, kos, trainers, extra FROM board WHERE name = ANY(%s)", (names,))
+        rows = cur.fetchall()
+    RANK.apply([], names, rows)
+    found = {r["name"] for r in rows}
+    _live_broadcast({
+        "rows": [dict(RankIndex.row(RankIndex.key(r)), rank=RANK.rank_of(r["name"])) for r in rows],
+        "removed": [n for n in names if n not in found],
+    })
+
+def _live_loop():
+    """LISTEN bxh_board trên connection riêng; NOTIFY từ mọi worker gom lại theo LIVE_INTERVAL."""
+    while True:
+        try:
+            with psycopg.connect(DATABASE_URL, autocommit=True) as con:
+                con.execute("LISTEN bxh_board")
+                # NOTIFY lúc chưa / mất LISTEN đã trôi mất -> bỏ cache, bảo viewer tải lại trang đầu
+                board_invalidate()
+                _live_broadcast({"reset": True})
+                while True:
+                    names = {n.payload for n in con.notifies(timeout=LIVE_INTERVAL)}
+                    if names:
+                        _live_flush(con, names)
+        except Exception as e:
+            log(f"[LIVE][ERROR] {e}\n{traceback.format_exc()}")
+            time.sleep(5)
+
+def live_subscribe(q=None, limit=LIVE_MAX_SUBS):
+    """Đăng ký một hàng đợi nhận các lô live (mặc định queue.Queue; asgi.py truyền hàng đợi async
+    có put_nowait riêng); None nếu worker đã đủ `limit` kết nối."""
+    global _LIVE_THREAD
+    if q is None:
+        q = queue.Queue(maxsize=LIVE_QUEUE)
+    with _LIVE_LOCK:
+        if len(_LIVE_SUBS) >= limit:
+            return None
+        _LIVE_SUBS.add(q)
+        if _LIVE_THREAD is None:
+            _LIVE_THREAD = threading.Thread(target=_live_loop, name="live-listen", daemon=True)
+            _LIVE_THREAD.start()
+    return q
+
+def live_unsubscribe(q):
+    with _LIVE_LOCK:
+        _LIVE_SUBS.discard(q)
+
+@app.route("/api/live")
+def live_stream():
+    q = live_subscribe()
+    # đầy: 204 làm EventSource dừng hẳn (không reconnect dồn dập), trang chuyển sang tự hỏi lại định kỳ
+    if q is None: return Response(status=204, headers={"Cache-Control": "no-cache"})
+    def gen():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    ev = q.get(timeout=LIVE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield f"data: {json.dumps(ev, ensure_ascii=False)}\n\n"
+        finally:
+            live_unsubscribe(q)
+    return Response(gen(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# thứ hạng của một người chơi + n người ngay trên/dưới
+@app.route("/api/rank/<path:uid>")
+def api_rank(uid):
+    try:
+        n = min(max(int(request.args.get("n") or 5), 0), 50)
+    except ValueError:
+        return jsonify(error="bad n"), 400
+    rank_ensure_fresh()
+    res = RANK.lookup(uid, n)
+    if res is None: return jsonify(error="not found"), 404
+    return jsonify(ok=True, uid=uid, **res)
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        got = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        # so bytes: compare_digest với str non-ASCII ném TypeError
+        if not hmac.compare_digest(got.encode(), METRICS_TOKEN.encode()): return jsonify(error="bad token"), 401
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    gauges = {"bxh_live_subscribers": len(_LIVE_SUBS), "bxh_delta_buffer_pending": len(_DELTA_BUF),
+              "bxh_rank_index_size": len(RANK.keys)}
+    if _POOL is not None:
+        st = _POOL.get_stats()
+        gauges.update({"bxh_db_pool_size": st.get("pool_size", 0), "bxh_db_pool_available": st.get("pool_available", 0),
+                       "bxh_db_pool_waiting": st.get("requests_waiting", 0)})
+    for name, v in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {v}"]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+# thống kê pool để chỉnh DB_POOL_MIN/MAX cho từng worker
+@app.route("/api/pool_stats")
+def pool_stats():
+    if (request.args.get("token") or "") != TOKEN: return jsonify(error="bad token"), 401
+    if _POOL is None: return jsonify(ok=True, open=False)
+    return jsonify(ok=True, open=True, pid=os.getpid(), **_POOL.get_stats())
+
 # tiện reset từng bảng (PC/Android)
 @app.route("/api/clear_pc", methods=["POST"])
 def clear_pc():
     if (request.form.get("token") or "") != TOKEN: return jsonify(error="bad token"), 401
     with db_conn() as con, con.cursor() as cur: cur.execute("TRUNCATE TABLE scores")
+    board_invalidate()
+    rank_reload()
     return jsonify(ok=True)
 
 @app.route("/api/clear_android", methods=["POST"])
 def clear_android():
     if (request.form.get("token") or "") != TOKEN: return jsonify(error="bad token"), 401
     with db_conn() as con, con.cursor() as cur: cur.execute("TRUNCATE TABLE android_scores")
+    with _SEEN_LOCK: _SEEN.clear()
+    board_invalidate()
+    rank_reload()
     return jsonify(ok=True)
 
 @app.post("/api/clear")
@@ -423,9 +1804,229 @@ def clear_all():
     with db_conn() as con, con.cursor() as cur:
         cur.execute("TRUNCATE TABLE scores")
         cur.execute("TRUNCATE TABLE android_scores")
+    with _SEEN_LOCK: _SEEN.clear()
+    board_invalidate()
+    rank_reload()
     return jsonify(ok=True)
 
+# ========= EXPORT + MÙA GIẢI =========
+def _season_arg():
+    """?season=<id> -> int (None = BXH đang chạy); sai định dạng -> ValueError."""
+    s = request.args.get("season")
+    if not s: return None
+    try:
+        return int(s)
+    except ValueError:
+        raise ValueError("bad season")
+
+def _export_sql(sort, season, fmt):
+    """Câu COPY xuất cả BXH theo `sort` (thứ tự theo index, không sort trong RAM)."""
+    keys = BOARD_SORTS[sort]
+    table, where = ("board", "") if season is None else ("season_board", f"WHERE season_id = {int(season)}")
+    order = ", ".join(k + " DESC" for k in keys) + ", name"
+    select = f"""
+      SELECT row_number() OVER (ORDER BY {order}) AS pos, name, rounds, kos, trainers, extra
+      FROM {table} {where} ORDER BY {order}"""
+    if fmt == "csv":
+        return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    # NDJSON: một cột json mỗi dòng; dạng csv với quote/delimiter là ký tự điều khiển
+    # (json không bao giờ chứa chúng ở dạng thô) để COPY không escape gì thêm
+    return (f"COPY (SELECT row_to_json(t)::text FROM ({select}) t) TO STDOUT "
+            "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')")
+
+EXPORT_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+_EXPORT_SLOTS = threading.BoundedSemaphore(EXPORT_MAX)
+
+# Tải toàn bộ BXH (hoặc một mùa đã lưu): COPY TO STDOUT, gửi từng khối cho client -> RAM cố định
+@app.route("/api/export")
+def export_board():
+    fmt  = request.args.get("format") or "csv"
+    sort = request.args.get("sort") or "default"
+    if fmt not in EXPORT_TYPES: return jsonify(error="bad format"), 400
+    if sort not in BOARD_SORTS: return jsonify(error="bad sort"), 400
+    try:
+        season = _season_arg()
+    except ValueError as e:
+        return jsonify(error="bad request", detail=str(e)), 400
+    sql = _export_sql(sort, season, fmt)
+    # COPY chạy trên connection riêng: client tải chậm không giữ connection của pool
+    if not _EXPORT_SLOTS.acquire(blocking=False):
+        return jsonify(error="busy", detail="too many exports"), 503, {"Retry-After": "10"}
+    try:
+        con = psycopg.connect(DATABASE_URL, autocommit=True)
+    except Exception:
+        _EXPORT_SLOTS.release()
+        raise
+
+    held = True
+    def release():
+        # gọi khi stream xong, lỗi, hoặc server đóng response (HEAD, client ngắt sớm)
+        nonlocal held
+        if held:
+            held = False
+            con.close()
+            _EXPORT_SLOTS.release()
+    def gen():
+        try:
+            with con.cursor() as cur, cur.copy(sql) as copy:
+                for block in copy:
+                    yield bytes(block)
+        finally:
+            release()
+    fname = f"bxh-{'live' if season is None else f'season-{season}'}.{fmt}"
+    resp = Response(stream_with_context(gen()), mimetype=EXPORT_TYPES[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{fname}"', "Cache-Control": "no-cache"})
+    resp.call_on_close(release)
+    return resp
+
+@app.route("/api/seasons")
+def list_seasons():
+    with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT id, label, players, archived_at FROM seasons ORDER BY id DESC")
+        rows = [{**r, "archived_at": r["archived_at"].isoformat()} for r in cur.fetchall()]
+    return jsonify(ok=True, seasons=rows)
+
+# Kết thúc mùa: chụp bảng board vào season_board rồi xoá scores + android_scores, cùng một transaction
+@app.route("/api/archive_season", methods=["POST"])
+def archive_season():
+    if (request.form.get("token") or "") != TOKEN: return jsonify(error="bad token"), 401
+    label = (request.form.get("label") or "").strip()[:80] or time.strftime("%Y-%m-%d")
+    delta_flush()   # delta đang đệm trong worker này thuộc về mùa cũ
+    with db_conn() as con, con.cursor() as cur, con.transaction():
+        # chặn ghi cho tới khi xoá xong để không điểm nào rơi giữa hai mùa
+        cur.execute("LOCK TABLE scores, android_scores IN EXCLUSIVE MODE")
+        cur.execute("INSERT INTO seasons(label, players) SELECT %s, count(*) FROM board RETURNING id, players", (label,))
+        sid, players = cur.fetchone()
+        cur.execute("""
+          INSERT INTO season_board(season_id, name, rounds, kos, trainers, extra)
+          SELECT %s, name, rounds, kos, trainers, extra FROM board""", (sid,))
+        cur.execute("TRUNCATE TABLE scores, android_scores")
+    log(f"[SEASON] archived #{sid} '{label}' ({players} players)")
+    with _SEEN_LOCK: _SEEN.clear()
+    board_invalidate()
+    rank_reload()
+    return jsonify(ok=True, season=sid, label=label, players=players)
+
+# ========= LỊCH SỬ ĐIỂM (event + rollup) =========
+_HISTORY = {"next": 0.0}
+HISTORY_GRAINS = {"h": "hour", "d": "day"}
+
+def history_prune(chunk=10000):
+    """Xoá event/rollup quá hạn theo từng đợt `chunk` dòng; chỉ một worker dọn tại một thời điểm."""
+    jobs = [("score_events", "at < now() - make_interval(days => %s)", HISTORY_EVENTS_DAYS),
+            ("score_rollup", "grain = 'h' AND bucket < now() - make_interval(days => %s)", HISTORY_HOURLY_DAYS),
+            ("score_rollup", "grain = 'd' AND bucket < now() - make_interval(days => %s)", HISTORY_DAILY_DAYS)]
+    deleted = 0
+    with db_conn() as con, con.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(hashtext('bxh.history_prune'))")
+        if not cur.fetchone()[0]:
+            return 0
+        try:
+            for table, cond, days in jobs:
+                while True:
+                    cur.execute(f"""
+                      DELETE FROM {table} WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM {table} WHERE {cond} LIMIT %s))""", (days, chunk))
+                    deleted += cur.rowcount
+                    if cur.rowcount < chunk:
+                        break
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(hashtext('bxh.history_prune'))")
+    return deleted
+
+def _history_prune_bg():
+    try:
+        n = history_prune()
+        if n: log(f"[HISTORY] pruned {n} rows")
+    except Exception as e:
+        log(f"[HISTORY][ERROR] {e}\n{traceback.format_exc()}")
+
+def history_prune_maybe():
+    now = time.monotonic()
+    if now < _HISTORY["next"]:
+        return
+    with LOCK:
+        if now < _HISTORY["next"]:
+            return
+        _HISTORY["next"] = now + HISTORY_PRUNE_SEC
+    threading.Thread(target=_history_prune_bg, name="history-prune", daemon=True).start()
+
+@app.cli.command("prune-history")
+def prune_history_cmd():
+    """Xoá lịch sử điểm quá hạn (flask --app app prune-history)."""
+    log(f"[HISTORY] pruned {history_prune()} rows")
+
+# Form Top: hiệu suất KO/trận tốt nhất trong `hours` giờ gần đây, đọc từ rollup giờ
+# (cùng dạng top3 của board_babel.html: player / rounds / kos / trainer)
+@app.route("/api/form_top")
+def api_form_top():
+    try:
+        hours = min(max(int(request.args.get("hours") or 24), 1), HISTORY_HOURLY_DAYS * 24)
+        n     = min(max(int(request.args.get("n") or 3), 1), 50)
+    except ValueError:
+        return jsonify(error="bad request"), 400
+    with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+        cur.execute("""
+          SELECT name AS player, SUM(rounds)::int AS rounds, SUM(kos)::int AS kos, SUM(trainers)::int AS trainer
+          FROM score_rollup
+          WHERE grain = 'h' AND bucket >= date_trunc('hour', now()) - make_interval(hours => %s)
+          GROUP BY name
+          HAVING SUM(rounds) >= %s
+          ORDER BY SUM(kos)::float8 / SUM(rounds) DESC, SUM(kos) DESC, name
+          LIMIT %s
+        """, (hours - 1, max(FORM_MIN_ROUNDS, 1), n))
+        top = cur.fetchall()
+    return jsonify(ok=True, hours=hours, top3=top)
+
+# Tiến độ của một uid theo giờ/ngày (phần tăng trong từng bucket, PC + Android cộng chung)
+@app.route("/api/history/<path:uid>")
+def api_history(uid):
+    grain = request.args.get("grain") or "d"
+    if grain not in HISTORY_GRAINS: return jsonify(error="bad grain"), 400
+    keep = HISTORY_HOURLY_DAYS if grain == "h" else HISTORY_DAILY_DAYS
+    try:
+        days = min(max(int(request.args.get("days") or (2 if grain == "h" else 30)), 1), keep)
+    except ValueError:
+        return jsonify(error="bad days"), 400
+    with db_conn() as con, con.cursor(row_factory=dict_row) as cur:
+        cur.execute("""
+          SELECT bucket, SUM(rounds)::int AS rounds, SUM(kos)::int AS kos,
+                 SUM(trainers)::int AS trainers, SUM(extra)::int AS extra, SUM(n)::int AS n
+          FROM score_rollup
+          WHERE uid = %s AND grain = %s AND bucket >= date_trunc(%s, now()) - make_interval(days => %s)
+          GROUP BY bucket ORDER BY bucket
+        """, (uid, grain, HISTORY_GRAINS[grain], days))
+        points = [{**r, "bucket": r["bucket"].isoformat()} for r in cur.fetchall()]
+    return jsonify(ok=True, uid=uid, grain=grain, days=days, points=points)
+
+# ========= KHỞI ĐỘNG (gunicorn preload_app) =========
+def warm_up():
+    """Chạy trong gunicorn master trước khi fork: nạp rank index + trang /all vào RAM rồi đóng pool,
+    worker fork ra dùng chung bản đã nạp (copy-on-write) mà không mang connection của master theo."""
+    t0 = time.perf_counter()
+    try:
+        rank_reload()
+        board_snapshot()
+        log(f"[WARM] rank {len(RANK.keys)} rows + /all snapshot in {time.perf_counter() - t0:.2f}s")
+    except Exception as e:
+        log(f"[WARM][ERROR] {e}\n{traceback.format_exc()}")
+    finally:
+        db_close()
+
+def after_fork():
+    """post_fork: bỏ state gắn với master (pool, thread nền, executor) rồi mở pool riêng của worker."""
+    global _POOL, _DELTA_THREAD, _LIVE_THREAD, _BULK_POOL
+    _POOL = _DELTA_THREAD = _LIVE_THREAD = _BULK_POOL = None
+    _LIVE_SUBS.clear()
+    RANK.reloading = False
+    _HISTORY["next"] = 0.0
+    try:
+        db_pool()   # open() không chờ: connection được tạo nền trong lúc worker nhận request đầu
+    except Exception as e:
+        log(f"[DB][ERROR] {e}")
+
 if __name__ == "__main__":
+    migrate()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "10000")))
 
 
@@ -0,0 +1,337 @@
+"""Entry point ASGI (async) song song với WSGI `app:app`: cùng route, cùng HMAC/chống replay, cùng HTML.
+
+Chạy:
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+    uvicorn asgi:application --port $PORT --workers 2
+
+Các đường nóng (POST /api/report, POST /api/upload_android, GET /all) chạy async trên
+AsyncConnectionPool nên một process giữ được hàng nghìn upload đang chờ Neon mà không tốn
+thread. GET /api/live (SSE) cũng chạy async: mỗi người xem chỉ là một asyncio.Queue.
+Mọi route khác chuyển nguyên sang Flask app, chạy trong thread pool WEB_THREADS luồng.
+"""
+import asyncio, io, json, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import parse_etags
+
+import app as core
+
+ASYNC_POOL_MAX = int(core.os.environ.get("ASYNC_POOL_MAX", "20"))
+UPLOAD_MAX     = int(core.os.environ.get("UPLOAD_MAX", str(1024 * 1024)))   # byte / request async
+WSGI_THREADS   = int(core.os.environ.get("WEB_THREADS", "32"))              # thread cho các route Flask
+LIVE_MAX_ASYNC = int(core.os.environ.get("LIVE_MAX_ASYNC", "2000"))         # người xem SSE / process
+
+# ========= WSGI fallback =========
+_WSGI_POOL = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="bxh-wsgi")
+
+class _WsgiInstance(WsgiToAsgiInstance):
+    """Như WsgiToAsgi của asgiref nhưng chạy song song trong _WSGI_POOL (mặc định asgiref dồn mọi
+    request vào một thread chung) và luôn gọi close() của iterable (call_on_close: metrics, khoá /all)."""
+    def _run(self, body):
+        environ = self.build_environ(self.scope, body)
+        it = self.wsgi_application(environ, self.start_response)
+        try:
+            for output in it:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send({"type": "http.response.body", "body": output, "more_body": True})
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body"})
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self._run, thread_sensitive=False, executor=_WSGI_POOL)(body)
+
+async def _wsgi(scope, receive, send):
+    await _WsgiInstance(core.app)(scope, receive, send)
+
+# ========= DB (async) =========
+_APOOL = None
+_APOOL_LOCK = asyncio.Lock()
+
+# như app._db_check: chỉ ping connection đã nằm yên quá DB_POOL_CHECK_IDLE giây
+async def _reset(con):
+    con.bxh_idle_since = time.monotonic()
+
+async def _check(con):
+    if time.monotonic() - getattr(con, "bxh_idle_since", 0.0) > core.DB_POOL_CHECK_IDLE:
+        await AsyncConnectionPool.check_connection(con)
+
+async def apool():
+    global _APOOL
+    if _APOOL is None:
+        async with _APOOL_LOCK:
+            if _APOOL is None:
+                if not core.DATABASE_URL:
+                    raise RuntimeError("Missing DATABASE_URL")
+                pool = AsyncConnectionPool(
+                    core.DATABASE_URL,
+                    min_size=core.DB_POOL_MIN,
+                    max_size=max(core.DB_POOL_MIN, ASYNC_POOL_MAX),
+                    timeout=core.DB_POOL_TIMEOUT,
+                    max_idle=core.DB_POOL_MAX_IDLE,
+                    max_lifetime=core.DB_POOL_MAX_LIFETIME,
+                    reconnect_timeout=core.DB_POOL_RECONNECT,
+                    check=_check,
+                    kwargs={"autocommit": True},
+                    configure=_reset,
+                    reset=_reset,
+                    name="bxh-async",
+                    open=False,
+                )
+                await pool.open()
+                _APOOL = pool
+    return _APOOL
+
+async def _rank_touch(con, pairs):
+    """Bản async của app._rank_touch_many."""
+    if not core.RANK.loaded_at or not pairs:
+        return
+    names = core._rank_names(pairs)
+    async with con.cursor(row_factory=dict_row) as cur:
+        await cur.execute(core.SQL_RANK_ROWS, (names,))
+        core.RANK.apply(pairs, names, await cur.fetchall())
+
+# ========= HTTP helpers =========
+class Request:
+    def __init__(self, scope, body):
+        self.scope, self.body = scope, body
+        self.method = scope["method"]
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+    def form_files(self):
+        """Parse form/multipart bằng parser của werkzeug (giống request.form / request.files)."""
+        environ = {
+            "REQUEST_METHOD": self.method,
+            "CONTENT_TYPE": self.headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(self.body)),
+            "wsgi.input": io.BytesIO(self.body),
+        }
+        _, form, files = parse_form_data(environ)
+        return form, files
+
+    def json(self):
+        if "json" not in self.headers.get("content-type", ""):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+async def _read_body(receive, limit):
+    chunks, size = [], 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return None
+        chunk = msg.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+async def _respond(send, status, body=b"", ctype=None, headers=()):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    hdrs = [(b"content-length", str(len(body)).encode())]
+    if ctype:
+        hdrs.append((b"content-type", ctype.encode()))
+    hdrs += [(k.encode(), v.encode()) for k, v in headers]
+    await send({"type": "http.response.start", "status": status, "headers": hdrs})
+    await send({"type": "http.response.body", "body": body})
+
+def jsonify(status=200, **obj):
+    # cùng định dạng với flask.jsonify (sort_keys, gọn, có xuống dòng)
+    return status, json.dumps(obj, sort_keys=True, separators=(",", ":")) + "\n", "application/json", ()
+
+def redirect(location, status=303):
+    return status, b"", None, (("location", location),)
+
+# ========= Routes =========
+async def report_pc(req):
+    try:
+        form, _ = req.form_files()
+        data = form.to_dict() or (req.json() or {})
+        if not data:                        return jsonify(400, error="no data")
+        if data.get("token") != core.TOKEN: return jsonify(401, error="bad token")
+
+        uid, name, action, rounds, kos, trainers, extra = core._parse_pc(data)
+        if core.REPORT_MODE == "buffered":
+            if action == "delta":
+                if core.delta_buffer_add(uid, name, (rounds, kos, trainers, extra)):
+                    return jsonify(202, ok=True, uid=uid, buffered=True)
+            else:
+                await asyncio.to_thread(core.delta_buffer_drop, uid)
+
+        pool = await apool()
+        async with pool.connection() as con, con.cursor(row_factory=dict_row) as cur:
+            await cur.execute(core.SQL_PC_DELTA if action == "delta" else core.SQL_PC_SET,
+                              (uid, name, rounds, kos, trainers, extra))
+            row = await cur.fetchone()
+            await _rank_touch(con, [(uid, name)])
+        core.board_invalidate()
+        return jsonify(ok=True, uid=uid, **row)
+    except Exception as e:
+        core.log(f"[PC][ERROR] {e}\n{traceback.format_exc()}")
+        return jsonify(500, error="internal", detail=str(e))
+
+async def upload_android(req):
+    try:
+        _, files = req.form_files()
+        f = files.get("file")
+        if not f:
+            core.M_UPLOADS.inc("single", "no file")
+            return jsonify(400, error="no file")
+        data = core._parse_bxh_file(f.read())
+
+        err = core._verify_bxh(data)
+        if err:
+            core.M_UPLOADS.inc("single", err)
+            return jsonify(400 if err == "missing sig" else 401, error=err)
+        rec = core._parse_android(data)
+
+        if core.android_seen(rec):
+            core.M_UPLOADS.inc("single", "duplicate")
+            return jsonify(409, error="duplicate", detail="same payload")
+        pool = await apool()
+        async with pool.connection() as con:
+            async with con.cursor(row_factory=dict_row) as cur:
+                await cur.execute(core.SQL_ANDROID_DELTA if rec["action"] == "delta" else core.SQL_ANDROID_SET, rec)
+                row = await cur.fetchone()
+                if core._android_recheck(row):
+                    await cur.execute(core.SQL_ANDROID_LAST, rec)
+                    row = {**row, **(await cur.fetchone() or {})}
+                outcome = core._android_outcome(row, rec)
+            if outcome == "ok":
+                await _rank_touch(con, [(rec["uid"], rec["name"])])
+        core.M_UPLOADS.inc("single", outcome)
+        if outcome != "stale":
+            core.android_seen(rec, add=True)
+        if outcome == "stale":
+            return jsonify(409, error="stale", detail="older timestamp")
+        if outcome == "duplicate":
+            return jsonify(409, error="duplicate", detail="same payload")
+
+        core.board_invalidate()
+        return redirect("/all")
+    except Exception as e:
+        core.M_UPLOADS.inc("single", "error")
+        core.log(f"[ANDROID][ERROR] {e}\n{traceback.format_exc()}")
+        return jsonify(500, error="internal", detail=str(e))
+
+async def board_all(req):
+    # cache nguội -> dựng lại bằng đúng template/đường render của app (trong thread)
+    if core._board_fresh():
+        body, etag = core._BOARD["body"], core._BOARD["etag"]
+    else:
+        body, etag = await asyncio.to_thread(core.board_snapshot, core.BOARD_BUILD_WAIT)
+    headers = (("etag", f'"{etag}"'), ("cache-control", "no-cache"))
+    if etag in parse_etags(req.headers.get("if-none-match")):
+        return 304, b"", None, headers
+    return 200, body, "text/html; charset=utf-8", headers
+
+# ========= LIVE (SSE, async) =========
+class _LiveQueue:
+    """Đứng trong app._LIVE_SUBS thay cho queue.Queue: thread LISTEN gọi put_nowait,
+    lô được chuyển sang asyncio.Queue trên event loop; đầy thì bỏ lô cũ và gửi reset."""
+    def __init__(self, loop):
+        self.loop, self.q = loop, asyncio.Queue(maxsize=core.LIVE_QUEUE)
+
+    def put_nowait(self, ev):
+        self.loop.call_soon_threadsafe(self._put, ev)
+
+    def _put(self, ev):
+        if self.q.full():
+            while not self.q.empty():
+                self.q.get_nowait()
+            ev = {"reset": True}
+        self.q.put_nowait(ev)
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def live_stream(scope, receive, send):
+    sub = _LiveQueue(asyncio.get_running_loop())
+    if core.live_subscribe(sub, LIVE_MAX_ASYNC) is None:
+        return 204
+    gone = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+        chunk = "retry: 3000\n\n"
+        while True:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+            get = asyncio.ensure_future(sub.q.get())
+            await asyncio.wait((get, gone), timeout=core.LIVE_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+            if get.done():
+                chunk = f"data: {json.dumps(get.result(), ensure_ascii=False)}\n\n"
+            else:
+                get.cancel()
+                chunk = ": ping\n\n"
+            if gone.done():
+                return 200
+    finally:
+        gone.cancel()
+        core.live_unsubscribe(sub)
+
+ROUTES = {
+    ("POST", "/api/report"):         (report_pc, "/api/report"),
+    ("POST", "/api/upload_android"): (upload_android, "/api/upload_android"),
+    ("GET",  "/all"):                (board_all, "/all"),
+}
+
+# ========= ASGI =========
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            try:
+                await apool()
+            except Exception as e:
+                core.log(f"[ASGI][ERROR] {e}\n{traceback.format_exc()}")
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(core.delta_flush)
+            if _APOOL is not None:
+                await _APOOL.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == "/api/live":
+        t0 = time.perf_counter()
+        status = await live_stream(scope, receive, send)
+        if status == 204:   # đầy -> như bản WSGI, trang chuyển sang tự hỏi lại định kỳ
+            await _respond(send, 204, headers=(("cache-control", "no-cache"),))
+        core.M_REQ_SECONDS.observe(time.perf_counter() - t0, "/api/live", "GET")
+        core.M_REQ_TOTAL.inc("/api/live", "GET", status)
+        return
+    route = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is None:
+        return await _wsgi(scope, receive, send)
+
+    handler, rule = route
+    t0 = time.perf_counter()
+    body = await _read_body(receive, UPLOAD_MAX)
+    if body is None:
+        status, payload, ctype, headers = jsonify(413, error="too large")
+    else:
+        status, payload, ctype, headers = await handler(Request(scope, body))
+    await _respond(send, status, payload, ctype, headers)
+    core.M_REQ_SECONDS.observe(time.perf_counter() - t0, rule, scope["method"])
+    core.M_REQ_TOTAL.inc(rule, scope["method"], status)
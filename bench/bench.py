@@ -0,0 +1,258 @@
+"""Benchmark tải cho đường ghi (/api/report, /api/upload_android) và đọc (/all).
+
+Ví dụ:
+    python bench/bench.py --players 10000 --requests 2000 --concurrency 16
+    python bench/bench.py --url http://localhost:10000 --scenarios all --compare bench/results/old.json
+
+DB: mặc định luôn tự dựng một Postgres tạm (initdb/pg_ctl trên PATH, hoặc gói `pgserver`) và bỏ qua
+DATABASE_URL của môi trường (thường là Neon thật). Muốn dùng DB khác phải truyền --db-url; host không
+phải máy local còn cần thêm --allow-remote-db (seed ghi hàng nghìn người chơi bench_* vào BXH).
+Server: mặc định tự chạy gunicorn app:app (gunicorn.conf.py của repo) trên --port; --url để bắn vào
+server có sẵn (không kèm --db-url thì không dựng Postgres tạm, không migrate / seed mà đo trên dữ liệu
+của chính server đó; meta.db = "server", meta.seeded = false). Kết quả (throughput, p50/p95/p99) ghi ra JSON trong bench/results/ để so sánh giữa các lần.
+"""
+import argparse, base64, http.client, itertools, json, os, random, shutil, socket, subprocess
+import sys, tempfile, threading, time, urllib.parse, uuid
+from contextlib import ExitStack
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = os.environ.get("API_TOKEN", "POKEMONVIETNAM")
+
+# ========= Postgres =========
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def local_postgres(stack):
+    """Postgres tạm cho benchmark; tự xoá khi xong."""
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if initdb and pg_ctl:
+        data = stack.enter_context(tempfile.TemporaryDirectory(prefix="bxh-bench-pg-"))
+        port = _free_port()
+        subprocess.run([initdb, "-D", data, "-U", "postgres", "--auth=trust"], check=True, capture_output=True)
+        subprocess.run([pg_ctl, "-D", data, "-w", "-l", os.path.join(data, "log"),
+                        "-o", f"-k {data} -p {port} -c listen_addresses=''", "start"], check=True, capture_output=True)
+        stack.callback(subprocess.run, [pg_ctl, "-D", data, "-m", "fast", "stop"], capture_output=True)
+        return f"postgresql://postgres@/postgres?host={data}&port={port}"
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("Không có initdb/pg_ctl hay gói pgserver để dựng Postgres tạm (hoặc truyền --db-url).")
+    data = stack.enter_context(tempfile.TemporaryDirectory(prefix="bxh-bench-pg-"))
+    srv = pgserver.get_server(data, cleanup_mode="stop")
+    stack.callback(srv.cleanup)
+    return srv.get_uri()
+
+def is_local_db(db_url):
+    """DSN trỏ vào Postgres trên máy này (unix socket hoặc loopback)?"""
+    from psycopg.conninfo import conninfo_to_dict
+    hosts = (conninfo_to_dict(db_url).get("host") or "").split(",")
+    return all(not h or h.startswith("/") or h in ("localhost", "127.0.0.1", "::1") for h in hosts)
+
+def seed(db_url, players):
+    """Nạp `players` người chơi PC + `players` Android giả (uid bench-*), dựng lại board một lần."""
+    # cả hàm là một transaction: ALTER TABLE giữ khoá nên không lệnh ghi nào khác lọt qua lúc trigger tắt,
+    # và nếu bị ngắt giữa chừng thì rollback -> trigger không bao giờ bị bỏ ở trạng thái tắt
+    import psycopg
+    rnd = random.Random(players)
+    with psycopg.connect(db_url) as con, con.cursor() as cur:
+        for table in ("scores", "android_scores"):
+            cur.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")   # board + history
+            cur.execute(f"DELETE FROM {table} WHERE uid LIKE 'bench-%%'")
+        with cur.copy("COPY scores (uid, name, rounds, kos, trainers, extra) FROM STDIN") as cp:
+            for i in range(players):
+                cp.write_row((f"bench-pc-{i}", f"bench_{i}", rnd.randint(0, 500), rnd.randint(0, 3000),
+                              rnd.randint(0, 60), rnd.randint(0, 50)))
+        with cur.copy("COPY android_scores (uid, name, rounds, kos, trainers, extra, last_ts, last_sig) FROM STDIN") as cp:
+            for i in range(players):
+                cp.write_row((f"bench-and-{i}", f"bench_{i}", rnd.randint(0, 500), rnd.randint(0, 3000),
+                              rnd.randint(0, 60), rnd.randint(0, 50), 0, ""))
+        for table in ("scores", "android_scores"):
+            cur.execute(f"ALTER TABLE {table} ENABLE TRIGGER USER")
+        cur.execute("SELECT board_rebuild()")
+        cur.execute("ANALYZE scores; ANALYZE android_scores; ANALYZE board")
+
+# ========= Server =========
+def start_server(stack, db_url, port, workers):
+    env = dict(os.environ, DATABASE_URL=db_url, PORT=str(port), WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stack.callback(proc.wait, 10)
+    stack.callback(proc.terminate)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/all")
+            conn.getresponse().read()
+            return f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.3)
+    sys.exit("gunicorn không lên sau 30s")
+
+# ========= Payload =========
+def signed_bxh(uid, name, ts, rnd):
+    """File .bxh hợp lệ: base64(JSON) ký bằng đúng _calc_sig/_msg_bytes của app."""
+    from app import _calc_sig
+    p = {"uid": uid, "name": name, "action": "delta", "rounds": 1, "kos": rnd.randint(0, 6),
+         "trainers": rnd.randint(0, 1), "extra": 0, "ts": ts, "alg": "sha1"}
+    p["sig"] = _calc_sig(p)
+    return base64.b64encode(json.dumps(p).encode("latin-1"))
+
+def multipart(field, filename, content):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+# ========= Scenarios =========
+# mỗi kịch bản: (rnd, ts) -> (method, path, body, headers)
+def sc_report(players):
+    def make(rnd, ts):
+        i = rnd.randrange(players)
+        body = urllib.parse.urlencode({"token": TOKEN, "uid": f"bench-pc-{i}", "name": f"bench_{i}",
+                                       "action": "delta", "rounds": 1, "kos": rnd.randint(0, 6)})
+        return "POST", "/api/report", body, {"Content-Type": "application/x-www-form-urlencoded"}
+    return make
+
+def sc_upload(players):
+    def make(rnd, ts):
+        i = rnd.randrange(players)
+        body, ctype = multipart("file", "bench.bxh", signed_bxh(f"bench-and-{i}", f"bench_{i}", ts, rnd))
+        return "POST", "/api/upload_android", body, {"Content-Type": ctype}
+    return make
+
+def sc_all(players):
+    return lambda rnd, ts: ("GET", "/all", None, {})
+
+SCENARIOS = {"report": sc_report, "upload": sc_upload, "all": sc_all}
+
+def run(base_url, make, requests, concurrency, seed_):
+    """Bắn `requests` request với `concurrency` thread (mỗi thread một kết nối keep-alive)."""
+    url = urllib.parse.urlsplit(base_url)
+    ts = itertools.count(int(time.time() * 1000))   # ts tăng dần -> upload không bị stale
+    ts_lock, left, left_lock = threading.Lock(), [requests], threading.Lock()
+    lat, status = [], {}
+
+    def worker(k):
+        rnd = random.Random(seed_ * 1000 + k)
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        mine, codes = [], {}
+        while True:
+            with left_lock:
+                if left[0] <= 0:
+                    break
+                left[0] -= 1
+            with ts_lock:
+                t = next(ts)
+            method, path, body, headers = make(rnd, t)
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                code = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+                code = "error"
+            mine.append(time.perf_counter() - t0)
+            codes[code] = codes.get(code, 0) + 1
+        conn.close()
+        with left_lock:
+            lat.extend(mine)
+            for c, n in codes.items():
+                status[str(c)] = status.get(str(c), 0) + n
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    t0 = time.perf_counter()
+    for th in threads: th.start()
+    for th in threads: th.join()
+    wall = time.perf_counter() - t0
+    lat.sort()
+    pct = lambda p: round(lat[min(len(lat) - 1, int(p / 100 * len(lat)))] * 1000, 3) if lat else None
+    return {"requests": len(lat), "seconds": round(wall, 3), "rps": round(len(lat) / wall, 1),
+            "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99),
+            "max_ms": round(lat[-1] * 1000, 3) if lat else None, "status": status}
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--players", type=int, default=1000, help="số người chơi giả mỗi nền tảng (1k-1M)")
+    ap.add_argument("--requests", type=int, default=1000, help="số request mỗi kịch bản")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--scenarios", default="report,upload,all")
+    ap.add_argument("--url", help="bắn vào server có sẵn thay vì tự chạy gunicorn")
+    ap.add_argument("--port", type=int, default=0, help="port cho gunicorn tự chạy (0 = ngẫu nhiên)")
+    ap.add_argument("--workers", type=int, default=2, help="số gunicorn worker tự chạy")
+    ap.add_argument("--db-url", help="Postgres dùng cho benchmark (mặc định: Postgres tạm, không dùng DATABASE_URL; "
+                                     "với --url thì bỏ qua migrate + seed nếu không có --db-url)")
+    ap.add_argument("--allow-remote-db", action="store_true", help="cho phép --db-url trỏ tới host không phải local")
+    ap.add_argument("--no-seed", action="store_true", help="không nạp lại dữ liệu giả")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="file JSON kết quả (mặc định bench/results/<thời điểm>.json)")
+    ap.add_argument("--compare", help="file JSON của lần chạy trước để so sánh")
+    args = ap.parse_args()
+
+    names = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in names if s not in SCENARIOS]
+    if unknown:
+        ap.error(f"kịch bản không có: {', '.join(unknown)}")
+
+    if args.db_url and not is_local_db(args.db_url) and not args.allow_remote_db:
+        ap.error("--db-url không phải Postgres local; thêm --allow-remote-db nếu chắc chắn muốn seed vào đó")
+
+    # --url không kèm --db-url: Postgres tạm không phải DB của server đó -> seed vào đó vô nghĩa
+    db_mode = "given" if args.db_url else ("server" if args.url else "local")
+    seeded = False
+    sys.path.insert(0, ROOT)
+    with ExitStack() as stack:
+        if db_mode == "server":
+            print("--url without --db-url: skipping local Postgres, migrate and seed; using the server's data as-is")
+        else:
+            db_url = args.db_url or local_postgres(stack)
+            os.environ["DATABASE_URL"] = db_url
+            import app
+            app.migrate()   # schema sẵn sàng để seed
+            if not args.no_seed:
+                t0 = time.perf_counter()
+                seed(db_url, args.players)
+                seeded = True
+                print(f"seeded {args.players} x2 players in {time.perf_counter() - t0:.1f}s")
+        base_url = args.url or start_server(stack, db_url, args.port or _free_port(), args.workers)
+
+        results = {}
+        for name in names:
+            res = run(base_url, SCENARIOS[name](args.players), args.requests, args.concurrency, args.seed)
+            results[name] = res
+            print(f"{name:8s} {res['rps']:9.1f} req/s  p50 {res['p50_ms']:8.2f}ms  p95 {res['p95_ms']:8.2f}ms  "
+                  f"p99 {res['p99_ms']:8.2f}ms  {res['status']}")
+
+    report = {"meta": {"at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git": _git_rev(), "players": args.players,
+                       "requests": args.requests, "concurrency": args.concurrency, "workers": args.workers,
+                       "url": args.url, "db": db_mode, "seeded": seeded, "python": sys.version.split()[0]},
+              "results": results}
+    out = args.out or os.path.join(ROOT, "bench", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"-> {out}")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            old = json.load(fh)["results"]
+        for name, res in results.items():
+            if name in old:
+                o = old[name]
+                print(f"{name:8s} rps {o['rps']} -> {res['rps']} ({(res['rps'] / o['rps'] - 1) * 100:+.1f}%)  "
+                      f"p95 {o['p95_ms']} -> {res['p95_ms']}ms")
+
+if __name__ == "__main__":
+    main()
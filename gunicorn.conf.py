@@ -0,0 +1,27 @@
+import os
+
+# gthread: mỗi worker chạy nhiều thread, dùng chung pool kết nối của worker đó
+worker_class = "gthread"
+workers      = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads      = int(os.environ.get("WEB_THREADS", "32"))   # > LIVE_MAX_SUBS (mỗi SSE giữ 1 thread)
+bind         = "0.0.0.0:" + os.environ.get("PORT", "10000")
+
+# PRELOAD_APP=1: import app một lần trong master, nạp sẵn rank index + trang /all rồi mới fork worker
+preload_app  = os.environ.get("PRELOAD_APP", "0") == "1"
+
+def when_ready(server):
+    # chạy trong master, trước khi fork worker đầu tiên
+    if server.cfg.preload_app:
+        from app import warm_up
+        warm_up()
+
+def post_fork(server, worker):
+    # worker không dùng lại pool/thread của master
+    if server.cfg.preload_app:
+        from app import after_fork
+        after_fork()
+
+def worker_exit(server, worker):
+    # REPORT_MODE=buffered: ghi nốt delta còn trong RAM trước khi worker tắt
+    from app import delta_flush
+    delta_flush()